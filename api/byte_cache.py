@@ -0,0 +1,87 @@
+import threading
+from collections import OrderedDict
+
+
+class ByteLRUCache:
+    """Thread-safe LRU cache of bytes values bounded by their total size.
+
+    Values larger than the whole budget are not cached. size_of maps a value to
+    its size in bytes, for caches that store bytes together with metadata.
+    Hit/miss counters are kept for the stats endpoint.
+    """
+
+    def __init__(self, max_bytes: int, size_of=len):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, count_miss: bool = True):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                if count_miss:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def record_miss(self):
+        """Count a miss for a lookup made with count_miss=False"""
+        with self._lock:
+            self.misses += 1
+
+    def put(self, key, value):
+        size = self.size_of(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= self.size_of(old)
+            self._entries[key] = value
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= self.size_of(evicted)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._bytes -= self.size_of(value)
+            return value
+
+    def discard_where(self, predicate):
+        """Drop every entry whose key matches the predicate"""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._bytes -= self.size_of(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }
@@ -0,0 +1,213 @@
+"""
+Coordination between the web worker processes started with WEB_WORKERS.
+
+Each worker keeps its own indexes, caches and SSE subscribers, so anything one
+worker changes has to reach the others:
+  - events (new images, evicted images) are appended to a log table in the
+    metadata database, which every worker tails every CLUSTER_POLL_INTERVAL
+    seconds and hands to the handlers registered with cluster_bus.on()
+  - one worker holds an flock on "<METADATA_DB>.leader" and runs the duties
+    that must happen once: retention, upload job recovery, event log pruning.
+    Recovery and pruning repeat every CLUSTER_LEADER_INTERVAL seconds, so the
+    uploads of a worker that died are picked up without a change of leader.
+    When the leader exits, the lock is released and another worker takes over
+  - raw uploads are claimed with an flock while a worker owns them, so job
+    recovery never picks up a file another worker is still processing
+
+With a single worker nothing is logged and the worker is always the leader.
+"""
+import os
+import time
+import asyncio
+import threading
+from collections import defaultdict
+from dotenv import load_dotenv
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows, where only a single worker is supported
+    fcntl = None
+
+from .constants import METADATA_DB, WEB_WORKERS, CLUSTER_POLL_INTERVAL, CLUSTER_EVENT_TTL, CLUSTER_LEADER_INTERVAL
+from .metadata import metadata_store
+
+
+load_dotenv(verbose=True, override=True)
+
+UNLOCKED = -1  # Claim given without flock, which Windows lacks (and it cannot remove open files)
+
+
+def web_workers() -> int:
+    """Get the number of web worker processes the service runs with"""
+    return max(1, int(os.getenv("WEB_WORKERS", WEB_WORKERS)))
+
+
+def claim(path: str):
+    """Lock a file for this process; returns the open descriptor, or None if another owner holds it.
+
+    Pass the descriptor to release() once the file is processed or removed.
+    """
+    if fcntl is None:
+        return UNLOCKED if os.path.exists(path) else None
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def release(fd):
+    if fd is not None and fd != UNLOCKED:
+        os.close(fd)  # Closing the descriptor drops its flock
+
+
+class ClusterBus:
+    """Event log shared by the web workers, plus the leader election.
+
+    publish() records an event for the other workers only; the publishing
+    worker applies the change itself. Handlers run on the polling thread, so
+    they must be thread-safe. on_leader callbacks run on the event loop once
+    this worker becomes the leader, and periodic ones again on every leader
+    tick.
+    """
+
+    def __init__(self, workers: int = None, interval: float = None):
+        self.workers = workers or web_workers()
+        self.interval = interval if interval is not None else float(os.getenv("CLUSTER_POLL_INTERVAL", CLUSTER_POLL_INTERVAL))
+        self.origin = os.getpid()
+        self.is_leader = False
+        self._handlers = defaultdict(list)
+        self._leader_callbacks = []
+        self._tick_callbacks = []
+        self._leader_fd = None
+        self._last_seq = 0
+        self._last_tick = 0.0
+        self._loop = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.sent = 0
+        self.received = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 1
+
+    def on(self, kind: str, callback):
+        """Call callback(data) for every event of this kind published by another worker"""
+        self._handlers[kind].append(callback)
+
+    def on_leader(self, callback, periodic: bool = False):
+        """Call callback() on the event loop when this worker becomes the leader.
+
+        A periodic callback is also called every CLUSTER_LEADER_INTERVAL
+        seconds while this worker leads (with several workers only).
+        """
+        self._leader_callbacks.append(callback)
+        if periodic:
+            self._tick_callbacks.append(callback)
+
+    def publish(self, kind: str, data: dict):
+        if not self.enabled:
+            return
+        try:
+            metadata_store.append_event(kind, data, self.origin)
+            self.sent += 1
+        except Exception as e:
+            print(f"Error publishing {kind} event to the other workers: {str(e)}")
+
+    def run_later(self, delay: float, callback, *args):
+        """Call callback(*args) on the event loop after delay seconds; safe from any thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.call_later, delay, callback, *args)
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        """Contend for leadership and start tailing the event log"""
+        self._loop = loop or asyncio.get_running_loop()
+        if not self.enabled:
+            self._become_leader()
+            return
+        self._last_seq = metadata_store.last_event_seq()
+        self._try_lead()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cluster-bus", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+        release(self._leader_fd)
+        self._leader_fd = None
+        self.is_leader = False
+
+    def _try_lead(self):
+        if fcntl is None:
+            return
+        path = os.getenv("METADATA_DB", METADATA_DB) + ".leader"
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return
+        self._leader_fd = fd
+        self._become_leader()
+
+    def _become_leader(self):
+        self.is_leader = True
+        if self.enabled:
+            print(f"Worker {self.origin} is the leader of {self.workers} workers")
+        for callback in self._leader_callbacks:
+            self._loop.call_soon_threadsafe(callback)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._poll()
+                if not self.is_leader:
+                    self._try_lead()
+                elif time.time() - self._last_tick > CLUSTER_LEADER_INTERVAL:
+                    self._tick()
+            except Exception as e:
+                print(f"Error polling the cluster event log: {str(e)}")
+
+    def _tick(self):
+        self._last_tick = time.time()
+        metadata_store.prune_events(self._last_tick - CLUSTER_EVENT_TTL)
+        for callback in self._tick_callbacks:
+            self._loop.call_soon_threadsafe(callback)
+
+    def _poll(self):
+        while True:
+            events = metadata_store.events_after(self._last_seq)
+            for seq, origin, kind, data in events:
+                self._last_seq = seq
+                if origin == self.origin:
+                    continue
+                self.received += 1
+                for callback in self._handlers.get(kind, []):
+                    try:
+                        callback(data)
+                    except Exception as e:
+                        print(f"Cluster {kind} handler failed: {str(e)}")
+            if not events:
+                return
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "worker": self.origin,
+            "leader": self.is_leader,
+            "events_sent": self.sent,
+            "events_received": self.received,
+            "last_event": self._last_seq
+        }
+
+
+cluster_bus = ClusterBus()
@@ -4,10 +4,88 @@ IMG_EXT = ".jpg"
 QR_EXT = ".png"
 IMAGES_DIR = "images"
 QR_DIR = "qr"
+RENDITIONS_DIR = "renditions"  # Downscaled copies of each image, one subdirectory per size
+INCOMING_DIR = "incoming"  # Raw uploads waiting for background watermarking
+INCOMING_EXT = ".upload"
+FAILED_EXT = ".failed"
+TEMP_EXT = ".tmp"  # Files being written; renamed into place once complete
+METADATA_DB = "gallery.db"  # SQLite file holding one record per image
+QR_URL_MARKER = ".deployed_url"  # Records the DEPLOYED_URL the QR codes in QR_DIR encode
+QR_CACHE_BYTES = 2 * 1024 * 1024  # Memory budget for cached QR PNGs
+IMAGE_CACHE_BYTES = 128 * 1024 * 1024  # Memory budget for cached image and rendition bytes
+
+MAX_UPLOAD_BYTES = 40 * 1024 * 1024  # Largest accepted upload body
+MAX_UPLOAD_PIXELS = 60_000_000  # Largest accepted upload resolution (width * height)
+UPLOAD_HEADER_BYTES = 128 * 1024  # Leading bytes of an upload read to check its format and dimensions
+MAX_BATCH_FILES = 16  # Most files accepted by one /upload/batch request
 
 IMG_QTY = 20  # Number of images to show in the gallery
-IMG_QTY_BUFFER = -1  # Number of additional images to keep in the directory
+STATS_PAGE_SIZE = 100  # Image records returned per /stats page
+IMAGES_PAGE_SIZE = 50  # Images returned per /api/images page
+MAX_PAGE_SIZE = 1000  # Largest page a client may ask for
+IMG_QTY_BUFFER = 0  # Number of additional images to keep in the directory
+RETENTION_INTERVAL = 60  # Seconds between scheduled retention runs
+RETENTION_LOW_WATERMARK = 0.9  # A byte-limit eviction frees space down to this fraction of the limit
+MAX_TRACKED_JOBS = 1000  # Number of upload job records kept for /jobs lookups
+FAILED_UPLOAD_TTL = 24 * 3600  # Seconds a raw upload whose job failed is kept for inspection
+MAX_FAILED_UPLOADS = 20  # Most failed raw uploads kept, newest first
+WEB_WORKERS = 1  # Web worker processes serving requests
+CLUSTER_POLL_INTERVAL = 0.25  # Seconds between reads of the event log shared by the web workers
+CLUSTER_EVENT_TTL = 60  # Seconds an event stays in the shared log before it is pruned
+CLUSTER_ANNOUNCE_DELAY = 1  # Seconds the leader waits before announcing an image no worker announced
+CLUSTER_LEADER_INTERVAL = 10  # Seconds between the leader's periodic duties (event pruning, upload job recovery)
+INCOMING_GRACE = 10  # Seconds a raw upload stays with the worker that received it before job recovery may take it
+
+JPEG_QUALITY = 95  # Quality used when encoding watermarked uploads
+
+# JPEG encoder profiles for watermarked uploads, picked with JPEG_PROFILE; any setting can be
+# overridden with JPEG_<SETTING>. Compare them with benchmarks/jpeg_profile_benchmark.py.
+# quality/subsampling "keep" reuse the camera's own quantization tables and chroma subsampling.
+JPEG_PROFILE = "high"
+JPEG_PROFILES = {
+    # How uploads have always been encoded
+    "high": {"quality": JPEG_QUALITY, "subsampling": "4:2:0", "progressive": False, "optimize": False,
+             "keep_exif": False, "keep_icc": False},
+    # Smaller and quicker to encode, baseline for the fastest decode
+    "fast": {"quality": 85, "subsampling": "4:2:0", "progressive": False, "optimize": False,
+             "keep_exif": True, "keep_icc": True},
+    # Smallest files; optimized Huffman tables cost some encode time
+    "compact": {"quality": 82, "subsampling": "4:2:0", "progressive": True, "optimize": True,
+                "keep_exif": True, "keep_icc": True},
+    # Re-encode with the upload's own tables, keeping its metadata
+    "source": {"quality": "keep", "subsampling": "keep", "progressive": False, "optimize": False,
+               "keep_exif": True, "keep_icc": True}
+}
+
+# Renditions generated at upload, as bounding boxes (width, height); "original" is the full image
+RENDITION_SIZES = {
+    "thumb": (400, 400),  # Gallery thumbnails
+    "screen": (1920, 1920)  # Main preview and latest image page
+}
+ORIGINAL_SIZE = "original"
+RENDITION_QUALITY = 85
+
+# Modern formats encoded for each rendition besides JPEG, in order of preference.
+# Formats the installed Pillow cannot write are skipped (AVIF needs Pillow >= 11.3 or pillow-avif-plugin).
+RENDITION_FORMATS = {
+    "image/avif": {"ext": ".avif", "format": "AVIF", "quality": 60},
+    "image/webp": {"ext": ".webp", "format": "WEBP", "quality": 80}
+}
+
+# Watermark settings applied to every upload
+WATERMARK_OPTIONS = {
+    "logo_path": "static/logo.png",
+    "font_size": 1200,
+    "bottom_right_image_path": "static/Oxy-logo-t.png",
+    "bottom_right_image_size": (300, 200),
+    "bottom_right_margin": 30,  # Margin from edges
+    "bottom_right_opacity": 255,  # Full opacity
+    "preserve_bottom_right_aspect": True
+}
 
 # Ensure directories exist
 os.makedirs(IMAGES_DIR, exist_ok=True)
 os.makedirs(QR_DIR, exist_ok=True)
+os.makedirs(INCOMING_DIR, exist_ok=True)
+for rendition_size in RENDITION_SIZES:
+    os.makedirs(os.path.join(RENDITIONS_DIR, rendition_size), exist_ok=True)
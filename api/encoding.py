@@ -0,0 +1,75 @@
+import os
+from PIL import Image, ExifTags
+from dotenv import load_dotenv
+
+from .constants import JPEG_PROFILES, JPEG_PROFILE, JPEG_QUALITY
+
+
+load_dotenv(verbose=True, override=True)
+
+KEEP = "keep"  # quality/subsampling value that reuses the source JPEG's tables
+MAX_EXIF_BYTES = 65533  # Largest EXIF block that fits in a JPEG APP1 segment
+
+
+def _parse_setting(value: str, default):
+    if isinstance(default, bool):
+        return value.lower() in ("1", "true", "yes", "on")
+    if value.isdigit():
+        return int(value)
+    return value
+
+
+def jpeg_profile(name: str = None) -> dict:
+    """Get the JPEG encoder settings: the JPEG_PROFILE entry of JPEG_PROFILES with any JPEG_<SETTING> overrides"""
+    name = (name or os.getenv("JPEG_PROFILE", JPEG_PROFILE)).lower()
+    if name not in JPEG_PROFILES:
+        raise ValueError(f"Unknown JPEG profile '{name}', expected one of {', '.join(JPEG_PROFILES)}")
+    profile = dict(JPEG_PROFILES[name])
+    for setting, default in JPEG_PROFILES[name].items():
+        value = os.getenv(f"JPEG_{setting.upper()}")
+        if value is not None:
+            profile[setting] = _parse_setting(value, default)
+    return profile
+
+
+def source_metadata(image: Image.Image, profile: dict) -> dict:
+    """Get the EXIF and ICC profile of a decoded upload to carry over to its JPEG, as the profile asks.
+
+    The orientation tag is dropped: it has already been applied to the pixels
+    (see WatermarkTemplate.open), so keeping it would rotate the image twice.
+    """
+    metadata = {}
+    if profile.get("keep_exif"):
+        exif = image.getexif()
+        exif.pop(ExifTags.Base.Orientation, None)
+        exif_bytes = exif.tobytes() if exif else b""
+        if len(exif_bytes) > MAX_EXIF_BYTES:
+            print(f"Dropping {len(exif_bytes)} bytes of EXIF, more than a JPEG can hold")
+        elif exif_bytes:
+            metadata["exif"] = exif_bytes
+    if profile.get("keep_icc") and image.info.get("icc_profile"):
+        metadata["icc_profile"] = image.info["icc_profile"]
+    return metadata
+
+
+def jpeg_save_options(profile: dict, image: Image.Image = None, metadata: dict = None) -> dict:
+    """Get the Image.save keyword arguments that encode image as a JPEG with the profile.
+
+    "keep" settings only work while image is still the decoded upload JPEG
+    (e.g. after region compositing); otherwise they fall back to JPEG_QUALITY
+    and the encoder's default subsampling.
+    """
+    options = {
+        "format": "JPEG",
+        "quality": profile["quality"],
+        "subsampling": profile["subsampling"],
+        "progressive": profile["progressive"],
+        "optimize": profile["optimize"]
+    }
+    if not getattr(image, "quantization", None):
+        if options["quality"] == KEEP:
+            options["quality"] = JPEG_QUALITY
+        if options["subsampling"] == KEEP:
+            del options["subsampling"]
+    options.update(metadata or {})
+    return options
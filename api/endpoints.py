@@ -1,16 +1,26 @@
 import os
-import io
-from PIL import Image
-from fastapi import APIRouter, HTTPException, Request, UploadFile, File
-from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
+from fastapi import APIRouter, HTTPException, Request, Query
+from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse, JSONResponse, StreamingResponse, Response
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 from datetime import datetime
+from email.utils import formatdate
 import pytz
 
-from .services import get_images, save_image, get_image_path, generate_qr_code, get_basename_images, get_qr_path, get_qr_files, get_image_stats, get_qr_stats, delete_old_images
-from .constants import IMG_EXT, QR_EXT
-from functions.add_watermark_with_logo import add_watermark_with_logo
+from .services import get_images, get_image_path, get_qr_png, get_deployed_url, qr_cache, get_basename_images, get_basename_images_since, get_qr_path, get_qr_files, delete_image_file, delete_qr_file, get_image_candidates, get_cached_image, image_cache, delete_image_unit, get_record_stats, get_record_qr_stats, apply_index_change, is_own_image
+from .gallery_index import image_index
+from .constants import IMG_EXT, QR_EXT, IMG_QTY, RENDITION_SIZES, ORIGINAL_SIZE, STATS_PAGE_SIZE, IMAGES_PAGE_SIZE, MAX_PAGE_SIZE, MAX_BATCH_FILES, CLUSTER_ANNOUNCE_DELAY
+from .metadata import metadata_store
+from .pipeline import watermark_pool, ingest_upload, ingest_batch, PipelineBusyError
+from .jobs import upload_jobs, new_job_id, get_incoming_path
+from .uploads import stream_upload, stream_uploads, UploadRejected
+from .notifications import image_events
+from .watcher import gallery_watcher
+from .storage import directory_syncer
+from .retention import retention_service
+from .cluster import cluster_bus, claim, release
+from .http_cache import cached_bytes_response, cached_file_response, is_not_modified, not_modified_response, make_etag, IMMUTABLE_CACHE_CONTROL, LATEST_CACHE_CONTROL, QR_CACHE_CONTROL
 
 load_dotenv(verbose=True, override=True)
 
@@ -21,9 +31,65 @@ def basename_filter(path):
     return os.path.splitext(os.path.basename(path))[0]
 templates.env.filters['basename'] = basename_filter
 
-# New image flag
+# New image flag (one per web worker, each set by the images any worker commits)
 new_image_flag = False
 
+def mark_new_image(image_id: str):
+    """Flag that a new image was committed and push it to subscribed galleries"""
+    global new_image_flag
+    new_image_flag = True
+    image_events.publish(image_id)
+    cluster_bus.publish("new-images", {"image_ids": [image_id]})
+
+def mark_new_images(image_ids: list):
+    """Flag that several images were committed and push them to subscribed galleries as one event"""
+    global new_image_flag
+    new_image_flag = True
+    image_events.publish_batch(image_ids)
+    cluster_bus.publish("new-images", {"image_ids": image_ids})
+
+def _on_images_committed(data: dict):
+    # Committed by another web worker: list and announce them here too
+    global new_image_flag
+    image_ids = data["image_ids"]
+    for image_id in image_ids:
+        if image_id + IMG_EXT not in image_index:
+            try:
+                image_index.add(image_id + IMG_EXT)
+            except FileNotFoundError:
+                pass  # Already evicted
+    new_image_flag = True
+    if len(image_ids) == 1:
+        image_events.publish(image_ids[0])
+    else:
+        image_events.reserve(image_ids)
+        image_events.publish_batch(image_ids)
+    for image_id in image_ids:
+        retention_service.on_commit(image_id)
+
+def _announce_unseen(image_id: str):
+    if not image_events.announced(image_id):
+        mark_new_image(image_id)
+
+def _on_index_change(index, filename: str, added: bool):
+    # Files copied in by hand, or written by other web workers, which announce their own through cluster_bus
+    image_id = os.path.splitext(filename)[0]
+    if cluster_bus.is_leader:
+        apply_index_change(index, filename, added)
+    if not (added and index is image_index):
+        return
+    if not cluster_bus.enabled:
+        mark_new_image(image_id)
+    elif cluster_bus.is_leader:
+        # Give the worker that committed it time to announce it first
+        cluster_bus.run_later(CLUSTER_ANNOUNCE_DELAY, _announce_unseen, image_id)
+
+upload_jobs.on_commit = mark_new_image
+gallery_watcher.add_listener(_on_index_change)
+# Renamed in by this process's pool; publish_image indexes them once they are durable
+gallery_watcher.is_own_file = lambda filename: is_own_image(os.path.splitext(filename)[0])
+cluster_bus.on("new-images", _on_images_committed)
+
 # STAT ENDPOINTS
 # =========================
 @router.get("/health")
@@ -31,48 +97,95 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "ok", "message": "Unitree Gallery Service is running"}
 
+async def _get_page(limit: int, cursor: str = None) -> tuple:
+    try:
+        return await run_in_threadpool(metadata_store.page, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _image_urls(record: dict) -> dict:
+    image_id = record["id"]
+    urls = {ORIGINAL_SIZE: f"/images/{image_id}"}
+    for size in RENDITION_SIZES:
+        if size in record["renditions"]:
+            urls[size] = f"/images/{image_id}?size={size}"
+    urls["download"] = f"/download/{image_id}"
+    urls["qr"] = f"/qr/{image_id}"
+    return urls
+
 @router.get("/stats")
-async def get_stats():
-    """Get gallery statistics"""
-    image_files = get_images()
-    qr_files = get_qr_files()
-    total_images = len(image_files)
-    total_qr_codes = len(qr_files)
-    image_stats = []
-    qr_stats = []
-    for image_path in image_files:
-        try:
-            image_stats.append(get_image_stats(image_path))
-        except FileNotFoundError:
-            image_stats.append({
-                "filename": os.path.basename(image_path),
-                "last_modified": "N/A",
-                "size_in_bytes": -1,
-                "error": "error fetching file stats"
-            })
-    for qr_path in qr_files:
-        try:
-            qr_stats.append(get_qr_stats(qr_path))
-        except FileNotFoundError:
-            qr_stats.append({
-                "filename": os.path.basename(qr_path),
-                "last_modified": "N/A",
-                "size_in_bytes": -1,
-                "error": "error fetching file stats"
-            })
+async def get_stats(limit: int = Query(STATS_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: str = None):
+    """Get gallery statistics; image and QR code entries are paginated newest first (pass next_cursor for the next page)"""
+    summary = await run_in_threadpool(metadata_store.summary)
+    records, next_cursor = await _get_page(limit, cursor)
+    qr_records = [record for record in records if record["qr_generated_at"] is not None]
     return {
-        "images_exist": bool(image_files),
-        "total_images": total_images,
-        "image_files": image_files,
-        "image_stats": image_stats,
-        "total_qr_codes": total_qr_codes,
-        "qr_files": qr_files,
-        "qr_stats": qr_stats
+        "images_exist": summary["images"] > 0,
+        "total_images": summary["images"],
+        "total_image_bytes": summary["image_bytes"],
+        "image_files": [get_image_path(record["id"] + IMG_EXT) for record in records],
+        "image_stats": [get_record_stats(record) for record in records],
+        "total_qr_codes": summary["qr_codes"],
+        "qr_files": [get_qr_path(record["id"] + QR_EXT) for record in qr_records],
+        "qr_stats": [get_record_qr_stats(record) for record in qr_records],
+        "total_downloads": summary["downloads"],
+        "limit": limit,
+        "next_cursor": next_cursor,
+        "pipeline": watermark_pool.stats(),
+        "jobs": upload_jobs.stats(),
+        "events": image_events.stats(),
+        "qr_cache": qr_cache.stats(),
+        "image_cache": image_cache.stats(),
+        "storage": directory_syncer.stats(),
+        "retention": retention_service.stats(),
+        "cluster": cluster_bus.stats()
+    }
+
+@router.get("/events")
+async def image_event_stream(request: Request):
+    """Server-Sent Events stream announcing each new image ID as it is committed"""
+    return StreamingResponse(
+        image_events.stream(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/api/images")
+async def list_images(limit: int = Query(IMAGES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), cursor: str = None):
+    """List images newest first, one page at a time; pass next_cursor to get the next page"""
+    records, next_cursor = await _get_page(limit, cursor)
+    return {
+        "images": [{
+            "id": record["id"],
+            "created_at": record["created_at"],
+            "width": record["width"],
+            "height": record["height"],
+            "size_bytes": record["size_bytes"],
+            "urls": _image_urls(record)
+        } for record in records],
+        "limit": limit,
+        "next_cursor": next_cursor
+    }
+
+@router.get("/api/images/since")
+async def get_images_since(cursor: str = None):
+    """Get images added after the cursor image ID so galleries can update incrementally.
+
+    `visible` is the current gallery list; `reset` is true when the cursor is
+    unknown (e.g. deleted) and the client should rebuild from `visible`.
+    """
+    visible = get_basename_images()
+    new_images = get_basename_images_since(cursor) if cursor else None
+    return {
+        "cursor": visible[0] if visible else None,
+        "images": visible if new_images is None else new_images,
+        "visible": visible,
+        "reset": new_images is None
     }
 
 @router.get("/refresh")
 def check_for_new_images():
-    """Check for new images to refresh the gallery"""
+    """Check for new images to refresh the gallery (polling fallback for clients without /events)"""
     global new_image_flag
     if new_image_flag:
         new_image_flag = False
@@ -83,75 +196,177 @@ def check_for_new_images():
 
 # CONTROL ENDPOINTS
 # =========================
-@router.post("/upload")
-async def upload_image(file: UploadFile = File(...)):
-    """Upload an image file, add watermark and logo, then save it locally in images folder"""
+# Documents the multipart body, which upload_image parses itself to stream it to disk
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"]
+        }}}
+    }
+}
+
+@router.post("/upload", openapi_extra=UPLOAD_OPENAPI)
+async def upload_image(request: Request):
+    """Upload an image file, add watermark and logo, then save it locally in images folder.
+
+    The upload is streamed to disk and refused early (413/415) when it is too
+    large or not a JPEG, PNG or WebP image. With ASYNC_UPLOADS enabled a job ID
+    is returned right away; poll /jobs/{job_id} for the resulting image ID.
+    """
+    job_id = new_job_id()
+    incoming_path = get_incoming_path(job_id)
+    queued = os.getenv("ASYNC_UPLOADS", "False").lower() == "true"
     try:
-        # Read the uploaded file content
-        content = await file.read()
-
-        # Delete old images if necessary
+        # Only a queued upload must survive a restart; otherwise it is deleted once watermarked
+        await stream_upload(request, incoming_path, durable=queued)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+    if queued:
+        upload_jobs.submit(job_id)
+        return JSONResponse(status_code=202, content={
+            "status": "Image captured and queued for watermarking",
+            "job_id": job_id
+        })
+
+    claimed = claim(incoming_path)  # Keeps job recovery on the leader worker away from it
+    try:
+        # Watermark, flatten and encode in the worker pool so the event loop stays free
         try:
-            delete_old_images()
-        except Exception as e:
-            print(f"Error deleting old images: {str(e)}")
-        
-        # Add watermark and logo to the image
-        watermarked_image = add_watermark_with_logo(
-            image_content=content,
-            logo_path="static/logo.png",  # Adjust path as needed
-            font_size=1200,
-            bottom_right_image_path="static/Oxy-logo-t.png",  # Your bottom-right image
-            bottom_right_image_size=(300, 200),  # Adjust size as needed
-            bottom_right_margin=30,  # Margin from edges
-            bottom_right_opacity=255,  # Full opacity
-            preserve_bottom_right_aspect=True  # Preserve aspect ratio
-        )
-                # Convert RGBA to RGB if needed (JPEG doesn't support alpha)
-        if watermarked_image.mode == 'RGBA':
-            # Create a white background
-            rgb_image = Image.new('RGB', watermarked_image.size, (255, 255, 255))
-            rgb_image.paste(watermarked_image, mask=watermarked_image.split()[-1])  # Use alpha as mask
-            watermarked_image = rgb_image
-        # Convert PIL Image to bytes
-        img_bytes = io.BytesIO()
-        watermarked_image.save(img_bytes, format='JPEG', quality=95)
-        watermarked_content = img_bytes.getvalue()
-        
-        # Save the watermarked image
-        saved_path = save_image(watermarked_content)
+            saved_path = await ingest_upload(incoming_path)
+        except PipelineBusyError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
         
         if not saved_path:
             raise HTTPException(status_code=500, detail="Failed to save image")
         
-        # Set the new image flag
-        global new_image_flag
-        new_image_flag = True
+        mark_new_image(saved_path)
 
         return {
             "status": "Image captured, watermarked and uploaded successfully",
             "path": saved_path
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
-
+    finally:
+        if os.path.exists(incoming_path):
+            os.remove(incoming_path)
+        release(claimed)
+
+BATCH_UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"files": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+            "required": ["files"]
+        }}}
+    }
+}
+
+@router.post("/upload/batch", openapi_extra=BATCH_UPLOAD_OPENAPI)
+async def upload_image_batch(request: Request, all_or_nothing: bool = False):
+    """Upload several image files in one request and watermark them in parallel.
+
+    Files are sent as repeated 'files' fields in capture order. They are
+    watermarked across all pool workers at once, then listed together in
+    that order and announced to galleries with a single event. Each file gets
+    its own result; a refused or failed file does not stop the others unless
+    all_or_nothing is set. Batches are always processed before answering,
+    whatever ASYNC_UPLOADS says.
+    """
+    # Every file needs its own pipeline slot, so a batch never exceeds the pool's capacity
+    max_files = min(int(os.getenv("MAX_BATCH_FILES", MAX_BATCH_FILES)), watermark_pool.capacity)
+    incoming_paths = [get_incoming_path(new_job_id()) for _ in range(max_files)]
+    claims = []
+    try:
+        try:
+            uploads = await stream_uploads(request, incoming_paths)
+        except UploadRejected as e:
+            raise HTTPException(status_code=e.status_code, detail=str(e))
+        claims = [claim(path) for path in incoming_paths]
+        if not uploads:
+            raise HTTPException(status_code=400, detail="Missing 'files' file field")
+
+        results = [dict(upload) for upload in uploads]
+        accepted = [i for i, upload in enumerate(uploads) if "error" not in upload]
+        if all_or_nothing and len(accepted) < len(uploads):
+            raise HTTPException(status_code=422, detail={"status": "Batch refused", "results": results})
+
+        if accepted:
+            try:
+                processed = await ingest_batch([incoming_paths[i] for i in accepted], all_or_nothing=all_or_nothing)
+            except PipelineBusyError as e:
+                raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+            for i, outcome in zip(accepted, processed):
+                if "error" in outcome:
+                    results[i].update(status_code=500, error=outcome["error"])
+                else:
+                    results[i]["path"] = outcome["image_id"]
+
+        image_ids = [result["path"] for result in results if "path" in result]
+        if image_ids:
+            mark_new_images(image_ids)
+        if all_or_nothing and len(image_ids) < len(results):
+            raise HTTPException(status_code=422, detail={"status": "Batch refused", "results": results})
+        return {
+            "status": f"{len(image_ids)} of {len(results)} images captured, watermarked and uploaded",
+            "results": results
+        }
+    finally:
+        for path in incoming_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        for claimed in claims:
+            release(claimed)
+
+@router.get("/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Get the status of a queued upload and its image ID once processed"""
+    job = upload_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job with ID {job_id} not found")
+    return job
+
+
+def _check_size(size: str):
+    if size != ORIGINAL_SIZE and size not in RENDITION_SIZES:
+        raise HTTPException(status_code=400, detail=f"Unknown size '{size}', expected one of: {', '.join([ORIGINAL_SIZE, *RENDITION_SIZES])}")
+
+async def _serve_image_file(image_id: str, size: str, request: Request, cache_control: str = IMMUTABLE_CACHE_CONTROL):
+    """Serve an image from the hot image cache, negotiating WebP/AVIF renditions on the Accept header"""
+    headers = {"Vary": "Accept"} if size != ORIGINAL_SIZE else None
+    for path, media_type in get_image_candidates(image_id, size, request.headers.get("accept")):
+        # Hits are answered on the event loop; only a miss touches the disk
+        entry = image_cache.get(path, count_miss=False) or await run_in_threadpool(get_cached_image, path, media_type)
+        if entry is not None:
+            return cached_bytes_response(request, entry.data, entry.media_type, entry.etag,
+                                         entry.last_modified, cache_control, headers)
+    raise HTTPException(status_code=404, detail=f"Image with ID {image_id} not found")
 
 @router.get("/images/latest", response_class=FileResponse)
-async def serve_latest_image():
-    """Serve the saved image"""
-    image_files = get_images()
-    if not image_files:
+async def serve_latest_image(request: Request, size: str = ORIGINAL_SIZE):
+    """Serve the saved image (size: original, screen or thumb)"""
+    _check_size(size)
+    record = await run_in_threadpool(metadata_store.latest)
+    if record is None:
         raise HTTPException(status_code=404, detail="No image found")
-    return FileResponse(image_files[0], media_type="image/jpeg")
+    return await _serve_image_file(record["id"], size, request, LATEST_CACHE_CONTROL)
 
 @router.get("/images/{image_id}", response_class=FileResponse)
-async def serve_image(image_id: str):
-    """Serve the saved image"""
-    return FileResponse(get_image_path(image_id + IMG_EXT), media_type="image/jpeg")
+async def serve_image(image_id: str, request: Request, size: str = ORIGINAL_SIZE):
+    """Serve the saved image (size: original, screen or thumb)"""
+    _check_size(size)
+    return await _serve_image_file(image_id, size, request)
 
 @router.get("/download/{image_id}")
-async def download_image(image_id: str, rename_file: bool = True):
-    """Download the image file directly"""
+async def download_image(image_id: str, request: Request, rename_file: bool = True):
+    """Download the image file directly (supports Range requests to resume interrupted downloads)"""
     image_path = get_image_path(image_id + IMG_EXT)
 
     if not os.path.exists(image_path):
@@ -164,12 +379,17 @@ async def download_image(image_id: str, rename_file: bool = True):
         file_name = f"{image_id}{IMG_EXT}"
 
     print(f"Downloading image: {image_path} as {file_name}")
-    return FileResponse(
-        path=image_path,
-        media_type='application/octet-stream',  # use 'image/jpeg' if you prefer
-        filename=file_name,
+    response = cached_file_response(
+        request,
+        image_path,
+        'application/octet-stream',  # use 'image/jpeg' if you prefer
+        IMMUTABLE_CACHE_CONTROL,
         headers={"Content-Disposition": f'attachment; filename="{file_name}"'}
     )
+    # Count only downloads that send a body; one resumed with Range was counted when it started
+    if response.status_code != 304 and request.headers.get("range", "bytes=0-").startswith("bytes=0-"):
+        await run_in_threadpool(metadata_store.record_download, image_id)
+    return response
 
 @router.delete("/images/all")
 async def delete_all_images():
@@ -179,36 +399,52 @@ async def delete_all_images():
     image_files = get_images()
     qr_files = get_qr_files()
     for image_path in image_files:
-        os.remove(image_path)
+        delete_image_file(image_path)
     for qr_path in qr_files:
-        os.remove(qr_path)
+        delete_qr_file(qr_path)
     return {"status": "success", "message": "All images deleted successfully"}
 
 @router.delete("/images/{image_id}")
 async def delete_image(image_id: str):
     """Delete the image file"""
     image_path = get_image_path(image_id + IMG_EXT)
-    qr_path = get_qr_path(image_id + QR_EXT)
 
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail=f"Image with ID {image_id} not found")
 
-    os.remove(image_path)
-    if os.path.exists(qr_path):
-        os.remove(qr_path)
+    # The image, its renditions and its QR code go together
+    delete_image_unit(image_id)
     return {"status": "success", "message": "Image deleted successfully"}
 
 
 @router.get("/qr/{image_id}")
-async def get_qr_code(image_id: str):
+async def get_qr_code(image_id: str, request: Request):
     """Get the QR code for a specific image"""
     image_path = get_image_path(image_id + IMG_EXT)
     if not os.path.exists(image_path):
         raise HTTPException(status_code=404, detail=f"Image with ID {image_id} not found")
 
-    # Generate QR code pointing to the download URL
-    qr_code_path = generate_qr_code(image_id)
-    return FileResponse(qr_code_path, media_type="image/png")
+    # The QR only depends on the image ID and the download URL, so revalidate before generating
+    etag = make_etag(image_id, get_deployed_url())
+    if is_not_modified(request, etag):
+        return not_modified_response(etag, QR_CACHE_CONTROL)
+
+    # QR code pointing to the download URL, served from memory once generated
+    try:
+        qr_png = await run_in_threadpool(get_qr_png, image_id)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    # Regenerated (with a new mtime) whenever DEPLOYED_URL changes, so If-Modified-Since is checked only now
+    try:
+        last_modified = os.path.getmtime(get_qr_path(image_id + QR_EXT))
+    except FileNotFoundError:
+        last_modified = None  # Evicted meanwhile; the bytes in hand are still current
+    headers = {"ETag": etag, "Cache-Control": QR_CACHE_CONTROL}
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified, usegmt=True)
+        if is_not_modified(request, etag, last_modified):
+            return not_modified_response(etag, QR_CACHE_CONTROL, {"Last-Modified": headers["Last-Modified"]})
+    return Response(content=qr_png, media_type="image/png", headers=headers)
 
 
 # ====================
@@ -226,8 +462,7 @@ async def redirect_to_latest():
 async def single_photo_page(request: Request):
     """Serve the latest photo HTML page with the saved image"""
     # Check if image exists
-    image_exists = bool(get_images())
-    print(get_images())
+    image_exists = len(image_index) > 0
     
     return templates.TemplateResponse("latest_image.html", {
         "request": request, 
@@ -237,7 +472,8 @@ async def single_photo_page(request: Request):
 @router.get("/gallery", response_class=HTMLResponse)
 async def gallery_page(request: Request):
     """Show all images in a gallery"""
-    image_files = get_basename_images()
+    records = await run_in_threadpool(metadata_store.recent, IMG_QTY)
+    image_files = [record["id"] for record in records]
     
     return templates.TemplateResponse("gallery.html", {
         "request": request,
@@ -0,0 +1,123 @@
+import os
+import bisect
+import threading
+
+from .constants import IMG_EXT, QR_EXT, IMAGES_DIR, QR_DIR
+from .layout import layout_path, scan_files
+
+
+class GalleryIndex:
+    """Process-wide listing of the files in a gallery directory, ordered by mtime.
+
+    The directory is scanned once on first use; afterwards save/delete paths
+    update the index incrementally so listings never touch the filesystem.
+    """
+
+    def __init__(self, directory: str, ext: str):
+        self.directory = directory
+        self.ext = ext
+        self._order = []  # (mtime, filename) sorted oldest first
+        self._mtimes = {}  # filename -> mtime
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load(self):
+        """(Re)build the index from a directory scan"""
+        with self._lock:
+            entries = sorted((mtime, name) for name, _, mtime in scan_files(self.directory, self.ext))
+            self._order = entries
+            self._mtimes = {name: mtime for mtime, name in entries}
+            self._loaded = True
+
+    def path(self, filename: str) -> str:
+        """Get the full path of an indexed file under the storage layout"""
+        return layout_path(self.directory, filename)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def add(self, filename: str, mtime: float = None):
+        """Add or refresh a file; mtime defaults to the file's current mtime"""
+        if not filename.endswith(self.ext):
+            return
+        if mtime is None:
+            mtime = os.path.getmtime(self.path(filename))
+        with self._lock:
+            self._ensure_loaded()
+            self._discard(filename)
+            entry = (mtime, filename)
+            if not self._order or self._order[-1] <= entry:
+                self._order.append(entry)  # Common case: the newest file
+            else:
+                bisect.insort(self._order, entry)
+            self._mtimes[filename] = mtime
+
+    def remove(self, filename: str):
+        """Drop a file from the index if present"""
+        with self._lock:
+            self._ensure_loaded()
+            self._discard(filename)
+
+    def _discard(self, filename: str):
+        mtime = self._mtimes.pop(filename, None)
+        if mtime is None:
+            return
+        i = bisect.bisect_left(self._order, (mtime, filename))
+        if i < len(self._order) and self._order[i] == (mtime, filename):
+            del self._order[i]
+
+    def clear(self):
+        with self._lock:
+            self._order = []
+            self._mtimes = {}
+            self._loaded = True
+
+    def names(self, limit: int = None) -> list:
+        """Get filenames, newest first"""
+        with self._lock:
+            self._ensure_loaded()
+            end = len(self._order) if limit is None else min(limit, len(self._order))
+            return [self._order[-1 - i][1] for i in range(end)]
+
+    def paths(self, limit: int = None) -> list:
+        """Get file paths, newest first"""
+        return [self.path(name) for name in self.names(limit)]
+
+    def newer_than(self, filename: str, limit: int = None):
+        """Get filenames added after filename, newest first; None if filename is not indexed"""
+        with self._lock:
+            self._ensure_loaded()
+            mtime = self._mtimes.get(filename)
+            if mtime is None:
+                return None
+            start = bisect.bisect_right(self._order, (mtime, filename))
+            if limit is not None:
+                start = max(start, len(self._order) - limit)
+            return [name for _, name in reversed(self._order[start:])]
+
+    def entries(self) -> list:
+        """Get (mtime, filename) pairs, oldest first"""
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._order)
+
+    def mtime(self, filename: str):
+        """Get the indexed mtime of a file, or None if it is not indexed"""
+        with self._lock:
+            self._ensure_loaded()
+            return self._mtimes.get(filename)
+
+    def __contains__(self, filename: str) -> bool:
+        with self._lock:
+            self._ensure_loaded()
+            return filename in self._mtimes
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._order)
+
+
+image_index = GalleryIndex(IMAGES_DIR, IMG_EXT)
+qr_index = GalleryIndex(QR_DIR, QR_EXT)
@@ -0,0 +1,127 @@
+import os
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import HTTPException, Request
+from fastapi.responses import Response, FileResponse
+
+# Image and QR IDs are random UUIDs, so the bytes behind an ID never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# /images/latest points at a different file after every upload
+LATEST_CACHE_CONTROL = "public, max-age=2, must-revalidate"
+# A QR code encodes DEPLOYED_URL, which may change, so caches revalidate it on every use
+QR_CACHE_CONTROL = "public, no-cache"
+
+
+def make_etag(*parts) -> str:
+    """Build a strong ETag from the parts that identify a representation"""
+    digest = hashlib.md5(":".join(str(p) for p in parts).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Check an If-None-Match header value against an ETag"""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]  # If-None-Match uses weak comparison
+        if tag == "*" or tag == etag:
+            return True
+    return False
+
+
+def is_not_modified(request: Request, etag: str, last_modified: float = None) -> bool:
+    """Evaluate If-None-Match (preferred) or If-Modified-Since for a GET request"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def not_modified_response(etag: str, cache_control: str, headers: dict = None) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control, **(headers or {})})
+
+
+def cached_file_response(request: Request, path: str, media_type: str, cache_control: str,
+                         headers: dict = None, etag: str = None) -> Response:
+    """Serve a file with ETag/Last-Modified/Cache-Control, answering 304 when the client copy is current.
+
+    FileResponse handles Range/If-Range itself and hands the file to the server
+    with the http.response.pathsend extension (sendfile) when the server supports it.
+    """
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+    etag = etag or make_etag(os.path.basename(path), stat_result.st_size, stat_result.st_mtime_ns)
+    headers = dict(headers or {})
+    if is_not_modified(request, etag, stat_result.st_mtime):
+        return not_modified_response(etag, cache_control, headers)
+    headers.update({
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": cache_control
+    })
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+
+def parse_byte_range(range_header: str, size: int):
+    """Parse a single-range `bytes=` Range header into inclusive (start, end).
+
+    Returns None when the header should be ignored (absent, malformed or
+    multi-range, which is answered with the full body) and raises a 416 when
+    the range cannot be satisfied.
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            start = max(0, size - int(last))  # Suffix range: the last N bytes
+            end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end or end < 0:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, min(end, size - 1)
+
+
+def if_range_matches(request: Request, etag: str, last_modified: float) -> bool:
+    """Check If-Range; a Range request only gets a partial body while the validator still matches"""
+    if_range = request.headers.get("if-range")
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == etag
+    return if_range == formatdate(last_modified, usegmt=True)
+
+
+def cached_bytes_response(request: Request, data: bytes, media_type: str, etag: str, last_modified: float,
+                          cache_control: str, headers: dict = None) -> Response:
+    """Serve in-memory bytes with ETag/Last-Modified/Cache-Control and Range support, answering 304 when the client copy is current"""
+    headers = dict(headers or {})
+    if is_not_modified(request, etag, last_modified):
+        return not_modified_response(etag, cache_control, headers)
+    headers.update({
+        "ETag": etag,
+        "Last-Modified": formatdate(last_modified, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes"
+    })
+    byte_range = parse_byte_range(request.headers.get("range"), len(data))
+    if byte_range and if_range_matches(request, etag, last_modified):
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+        return Response(content=data[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+    return Response(content=data, media_type=media_type, headers=headers)
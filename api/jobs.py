@@ -0,0 +1,210 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+from uuid import uuid4
+from starlette.concurrency import run_in_threadpool
+
+from .constants import INCOMING_DIR, INCOMING_EXT, FAILED_EXT, MAX_TRACKED_JOBS, INCOMING_GRACE, FAILED_UPLOAD_TTL, MAX_FAILED_UPLOADS
+from .pipeline import ingest_upload, watermark_pool, PipelineBusyError
+from .metadata import metadata_store
+from .cluster import cluster_bus, claim, release
+
+JOB_QUEUED = "queued"
+JOB_PROCESSING = "processing"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def get_incoming_path(job_id: str, incoming_dir: str = INCOMING_DIR) -> str:
+    """Get the full path of a raw upload waiting to be processed"""
+    return os.path.join(incoming_dir, f"{job_id}{INCOMING_EXT}")
+
+
+def new_job_id() -> str:
+    """Create a new unique upload job ID"""
+    return f"job_{uuid4()}"
+
+
+def get_failed_uploads(incoming_dir: str = INCOMING_DIR) -> list:
+    """Get (mtime, path) of the raw uploads kept after their job failed, newest first"""
+    failed = []
+    if not os.path.isdir(incoming_dir):
+        return failed
+    with os.scandir(incoming_dir) as it:
+        for entry in it:
+            if entry.name.endswith(FAILED_EXT):
+                try:
+                    failed.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+    return sorted(failed, reverse=True)
+
+
+def prune_failed_uploads(incoming_dir: str = INCOMING_DIR) -> int:
+    """Delete failed raw uploads older than FAILED_UPLOAD_TTL or beyond the newest MAX_FAILED_UPLOADS; returns how many"""
+    max_age = float(os.getenv("FAILED_UPLOAD_TTL", FAILED_UPLOAD_TTL))
+    keep = int(os.getenv("MAX_FAILED_UPLOADS", MAX_FAILED_UPLOADS))
+    cutoff = time.time() - max_age
+    removed = 0
+    for position, (mtime, path) in enumerate(get_failed_uploads(incoming_dir)):
+        if position >= keep or mtime < cutoff:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+class UploadJobQueue:
+    """Background ingestion queue for uploads that are acknowledged before watermarking.
+
+    Raw uploads are streamed to INCOMING_DIR by the endpoint and submit() queues
+    them by job ID, so a queued job survives a restart; consumer tasks feed the
+    jobs through ingest_upload in arrival order. Job records are kept in memory
+    for the latest MAX_TRACKED_JOBS jobs, and also in the metadata store when
+    several web workers run, so /jobs answers whichever worker took the upload.
+    Each queued raw upload is claimed (see api.cluster) until its job ends.
+    """
+
+    def __init__(self, max_tracked: int = MAX_TRACKED_JOBS):
+        self.max_tracked = max_tracked
+        self._jobs = OrderedDict()
+        self._queue = None
+        self._consumers = []
+        self._claims = {}  # job ID -> descriptor locking its raw upload
+        self.on_commit = None  # Called with the image ID after each successful job
+
+    def start(self):
+        """Start consumer tasks"""
+        if self._consumers:
+            return
+        self._queue = asyncio.Queue()
+        for _ in range(watermark_pool.max_workers):
+            self._consumers.append(asyncio.create_task(self._consume()))
+
+    def recover(self):
+        """Requeue raw uploads left over from a previous run, or from a worker that died.
+
+        Run on the leader only, when it takes over and then periodically.
+        Files claimed by a live worker are skipped, and so are files renamed
+        into INCOMING_DIR less than INCOMING_GRACE seconds ago, which another
+        worker may have received and not claimed yet. Failed uploads past
+        their retention are deleted on the way.
+        """
+        self.start()
+        if not os.path.isdir(INCOMING_DIR):
+            return
+        prune_failed_uploads()
+        leftovers = []
+        cutoff = time.time() - INCOMING_GRACE if cluster_bus.enabled else float("inf")
+        for file_name in os.listdir(INCOMING_DIR):
+            try:
+                if file_name.endswith(INCOMING_EXT):
+                    stat_result = os.stat(os.path.join(INCOMING_DIR, file_name))
+                    if stat_result.st_ctime < cutoff:  # The rename into place updates ctime
+                        leftovers.append((stat_result.st_mtime, file_name))
+            except FileNotFoundError:
+                pass  # Processed by another worker meanwhile
+        for _, file_name in sorted(leftovers):
+            job_id = os.path.splitext(file_name)[0]
+            if job_id not in self._jobs:
+                self._enqueue(job_id)
+
+    async def stop(self):
+        for task in self._consumers:
+            task.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = []
+
+    def submit(self, job_id: str) -> str:
+        """Queue a raw upload already saved at get_incoming_path(job_id); returns the job ID"""
+        self.start()
+        self._enqueue(job_id)
+        return job_id
+
+    def get(self, job_id: str):
+        """Get the job record, or None if the job is unknown"""
+        job = self._jobs.get(job_id)
+        if job is None and cluster_bus.enabled:
+            return metadata_store.get_job(job_id)
+        return dict(job) if job else None
+
+    def stats(self) -> dict:
+        counts = {JOB_QUEUED: 0, JOB_PROCESSING: 0, JOB_DONE: 0, JOB_FAILED: 0}
+        for job in self._jobs.values():
+            counts[job["status"]] += 1
+        return {"tracked": len(self._jobs), "pending": self._queue.qsize() if self._queue else 0, **counts,
+                "failed_uploads": len(get_failed_uploads())}
+
+    def _enqueue(self, job_id: str):
+        fd = claim(get_incoming_path(job_id))
+        if fd is None:
+            return  # Gone, or owned by another worker
+        self._claims[job_id] = fd
+        now = time.time()
+        self._jobs[job_id] = {
+            "job_id": job_id,
+            "status": JOB_QUEUED,
+            "image_id": None,
+            "error": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        self._trim()
+        self._save(job_id, keep=self.max_tracked)
+        self._queue.put_nowait(job_id)
+
+    def _trim(self):
+        finished = [k for k, v in self._jobs.items() if v["status"] in (JOB_DONE, JOB_FAILED)]
+        while len(self._jobs) > self.max_tracked and finished:
+            del self._jobs[finished.pop(0)]
+
+    def _update(self, job_id: str, **fields):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.update(fields, updated_at=time.time())
+            self._save(job_id)
+
+    def _save(self, job_id: str, keep: int = None):
+        if cluster_bus.enabled:
+            try:
+                metadata_store.save_job(self._jobs[job_id], keep)
+            except Exception as e:
+                print(f"Error saving upload job {job_id}: {str(e)}")
+
+    async def _consume(self):
+        while True:
+            job_id = await self._queue.get()
+            path = get_incoming_path(job_id)
+            finished = True
+            try:
+                self._update(job_id, status=JOB_PROCESSING)
+                image_id = await ingest_upload(path)
+                await run_in_threadpool(os.remove, path)
+                self._update(job_id, status=JOB_DONE, image_id=image_id)
+                if self.on_commit:
+                    self.on_commit(image_id)
+            except asyncio.CancelledError:
+                raise
+            except PipelineBusyError:
+                # Synchronous uploads took every slot; retry once the pool drains
+                self._update(job_id, status=JOB_QUEUED)
+                finished = False
+                await asyncio.sleep(1)
+                self._queue.put_nowait(job_id)
+            except Exception as e:
+                print(f"Error processing upload job {job_id}: {str(e)}")
+                self._update(job_id, status=JOB_FAILED, error=str(e))
+                # Keep the raw upload for inspection without requeueing it on restart
+                if os.path.exists(path):
+                    os.replace(path, os.path.splitext(path)[0] + FAILED_EXT)
+                    await run_in_threadpool(prune_failed_uploads)
+            finally:
+                if finished:
+                    release(self._claims.pop(job_id, None))
+                self._queue.task_done()
+
+
+upload_jobs = UploadJobQueue()
@@ -0,0 +1,145 @@
+"""
+Where gallery files live inside their directory.
+
+"flat" keeps every file directly in the directory. "hashed" spreads them over
+256 subdirectories named after the first two hex digits of the MD5 of the
+file's ID (images/3f/img_<uuid>.jpg), which keeps each directory small for
+archives of tens of thousands of images. The layout is chosen with
+STORAGE_LAYOUT; existing files are moved between layouts with:
+
+    python -m api.layout --to hashed
+"""
+import os
+import hashlib
+import argparse
+from dotenv import load_dotenv
+
+from .constants import IMG_EXT, QR_EXT, IMAGES_DIR, QR_DIR, RENDITIONS_DIR, RENDITION_SIZES, RENDITION_FORMATS
+
+
+load_dotenv(verbose=True, override=True)
+
+FLAT_LAYOUT = "flat"
+HASHED_LAYOUT = "hashed"
+SHARD_CHARS = 2  # Hex digits per shard directory name, 16 ** 2 = 256 shards
+
+
+def storage_layout() -> str:
+    return os.getenv("STORAGE_LAYOUT", FLAT_LAYOUT).lower()
+
+
+def shard_name(file_name: str) -> str:
+    """Get the shard directory name of a file from its ID (the name without extension)"""
+    file_id = os.path.splitext(os.path.basename(file_name))[0]
+    return hashlib.md5(file_id.encode()).hexdigest()[:SHARD_CHARS]
+
+
+def _is_shard(name: str) -> bool:
+    return len(name) == SHARD_CHARS and all(c in "0123456789abcdef" for c in name)
+
+
+def layout_path(directory: str, file_name: str, layout: str = None) -> str:
+    """Get the path of a file in a gallery directory under the storage layout"""
+    if (layout or storage_layout()) == HASHED_LAYOUT:
+        return os.path.join(directory, shard_name(file_name), file_name)
+    return os.path.join(directory, file_name)
+
+
+def base_directory(path: str) -> str:
+    """Get the gallery directory a file path belongs to, under either layout"""
+    parent = os.path.dirname(path)
+    if os.path.basename(parent) == shard_name(path):
+        return os.path.dirname(parent)
+    return parent
+
+
+def shard_directories(directory: str) -> list:
+    """Get every shard directory of a gallery directory"""
+    return [os.path.join(directory, f"{i:0{SHARD_CHARS}x}") for i in range(16 ** SHARD_CHARS)]
+
+
+def ensure_layout(directory: str, layout: str = None):
+    """Create the shard directories up front so writers and watchers never race on them"""
+    os.makedirs(directory, exist_ok=True)
+    if (layout or storage_layout()) == HASHED_LAYOUT:
+        for shard in shard_directories(directory):
+            os.makedirs(shard, exist_ok=True)
+
+
+def _scan_directory(directory: str, ext):
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith(ext) and entry.is_file():
+                try:
+                    yield entry.name, entry.path, entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+
+
+def scan_files(directory: str, ext, layout: str = None):
+    """Yield (file name, path, mtime) for the files with the extension(s) stored under the layout"""
+    if not os.path.isdir(directory):
+        return
+    if (layout or storage_layout()) != HASHED_LAYOUT:
+        yield from _scan_directory(directory, ext)
+        return
+    with os.scandir(directory) as it:
+        shards = [entry.path for entry in it if _is_shard(entry.name) and entry.is_dir()]
+    for shard in shards:
+        yield from _scan_directory(shard, ext)
+
+
+def migrate(directory: str, ext, layout: str) -> int:
+    """Move the files of a gallery directory into the given layout; returns how many were moved"""
+    moved = 0
+    for other_layout in (FLAT_LAYOUT, HASHED_LAYOUT):
+        if other_layout == layout:
+            continue
+        for name, path, _ in list(scan_files(directory, ext, other_layout)):
+            target = layout_path(directory, name, layout)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(path, target)
+            moved += 1
+    if layout == FLAT_LAYOUT:
+        for shard in shard_directories(directory):
+            try:
+                os.rmdir(shard)
+            except OSError:
+                pass  # Missing, or still holds files with other extensions
+    return moved
+
+
+def gallery_directories() -> list:
+    """Get (directory, extensions) for every directory that follows the storage layout"""
+    rendition_exts = tuple([IMG_EXT] + [spec["ext"] for spec in RENDITION_FORMATS.values()])
+    directories = [(IMAGES_DIR, IMG_EXT), (QR_DIR, QR_EXT)]
+    directories += [(os.path.join(RENDITIONS_DIR, size), rendition_exts) for size in RENDITION_SIZES]
+    return directories
+
+
+def prepare_layout():
+    """Create the shard directories and warn about files still stored under the other layout"""
+    layout = storage_layout()
+    other_layout = FLAT_LAYOUT if layout == HASHED_LAYOUT else HASHED_LAYOUT
+    for directory, ext in gallery_directories():
+        ensure_layout(directory, layout)
+        misplaced = sum(1 for _ in scan_files(directory, ext, other_layout))
+        if misplaced:
+            print(f"Warning: {misplaced} files in {directory} use the {other_layout} layout and will not be served; "
+                  f"run `python -m api.layout --to {layout}`")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move gallery files into a storage layout (stop the service first)")
+    parser.add_argument("--to", choices=[FLAT_LAYOUT, HASHED_LAYOUT], required=True, help="Target layout")
+    args = parser.parse_args()
+    for directory, ext in gallery_directories():
+        if args.to == HASHED_LAYOUT:
+            ensure_layout(directory, HASHED_LAYOUT)
+        moved = migrate(directory, ext, args.to)
+        print(f"{directory}: moved {moved} files")
+    print(f"Done. Set STORAGE_LAYOUT={args.to} before starting the service.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import base64
+import sqlite3
+import threading
+from dotenv import load_dotenv
+
+from .constants import METADATA_DB
+
+
+load_dotenv(verbose=True, override=True)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    size_bytes INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    renditions TEXT NOT NULL DEFAULT '{}',
+    qr_generated_at REAL,
+    qr_size_bytes INTEGER,
+    download_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS images_created_at ON images (created_at, id);
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at REAL NOT NULL,
+    origin INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    image_id TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at);
+"""
+
+def encode_cursor(record: dict) -> str:
+    """Get the opaque page cursor pointing just past a record"""
+    return base64.urlsafe_b64encode(json.dumps([record["created_at"], record["id"]]).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Get (created_at, id) back from a page cursor, raising ValueError if it is malformed"""
+    try:
+        created_at, image_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return float(created_at), str(image_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+COLUMNS = ["id", "created_at", "size_bytes", "width", "height", "renditions", "qr_generated_at", "qr_size_bytes", "download_count"]
+
+
+class MetadataStore:
+    """SQLite table with one row per image: ID, created-at, size, dimensions,
+    rendition paths, QR status and download count.
+
+    Rows are written when an image is saved, deleted or its QR code changes,
+    so stats and listings are indexed queries instead of filesystem walks.
+    One connection is shared by all threads behind a lock; WAL mode lets
+    other processes read while this one writes. The same database holds the
+    event log and upload job records shared by the worker processes (see
+    api.cluster).
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("METADATA_DB", METADATA_DB)
+        self._conn = None
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _execute(self, sql: str, params: tuple = ()) -> int:
+        with self._lock:
+            return self._connect().execute(sql, params).rowcount
+
+    @staticmethod
+    def _row(row) -> dict:
+        record = dict(zip(COLUMNS, row))
+        record["renditions"] = json.loads(record["renditions"])
+        return record
+
+    def upsert(self, record: dict):
+        """Insert or replace an image record, keeping its download count"""
+        self._execute(
+            "INSERT INTO images (id, created_at, size_bytes, width, height, renditions, qr_generated_at, qr_size_bytes) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET created_at=excluded.created_at, size_bytes=excluded.size_bytes, "
+            "width=excluded.width, height=excluded.height, renditions=excluded.renditions, "
+            "qr_generated_at=COALESCE(excluded.qr_generated_at, images.qr_generated_at), "
+            "qr_size_bytes=COALESCE(excluded.qr_size_bytes, images.qr_size_bytes)",
+            (record["id"], record["created_at"], record["size_bytes"], record.get("width"), record.get("height"),
+             json.dumps(record.get("renditions") or {}), record.get("qr_generated_at"), record.get("qr_size_bytes"))
+        )
+
+    def delete(self, image_id: str):
+        self._execute("DELETE FROM images WHERE id = ?", (image_id,))
+
+    def set_qr(self, image_id: str, generated_at: float = None, size_bytes: int = None):
+        """Record that an image's QR code was generated, or removed when generated_at is None"""
+        self._execute("UPDATE images SET qr_generated_at = ?, qr_size_bytes = ? WHERE id = ?",
+                      (generated_at, size_bytes, image_id))
+
+    def record_download(self, image_id: str):
+        self._execute("UPDATE images SET download_count = download_count + 1 WHERE id = ?", (image_id,))
+
+    def get(self, image_id: str):
+        """Get an image record, or None if the image is unknown"""
+        rows = self._query(f"SELECT {', '.join(COLUMNS)} FROM images WHERE id = ?", (image_id,))
+        return self._row(rows[0]) if rows else None
+
+    def recent(self, limit: int = None, offset: int = 0) -> list:
+        """Get image records, newest first"""
+        rows = self._query(
+            f"SELECT {', '.join(COLUMNS)} FROM images ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset)
+        )
+        return [self._row(row) for row in rows]
+
+    def page(self, limit: int, cursor: str = None) -> tuple:
+        """Get up to limit records older than the cursor, newest first, and the cursor of the next page.
+
+        Keyset pagination on (created_at, id) walks the index, so every page
+        costs the same however deep it is, and uploads or deletions between
+        requests never shift records across pages.
+        """
+        sql = f"SELECT {', '.join(COLUMNS)} FROM images"
+        params = ()
+        if cursor:
+            sql += " WHERE (created_at, id) < (?, ?)"
+            params = decode_cursor(cursor)
+        rows = self._query(sql + " ORDER BY created_at DESC, id DESC LIMIT ?", params + (limit + 1,))
+        records = [self._row(row) for row in rows[:limit]]
+        next_cursor = encode_cursor(records[-1]) if len(rows) > limit else None
+        return records, next_cursor
+
+    def latest(self):
+        """Get the newest image record, or None if there are no images"""
+        records = self.recent(1)
+        return records[0] if records else None
+
+    def ids(self) -> set:
+        return {row[0] for row in self._query("SELECT id FROM images")}
+
+    def qr_ids(self) -> set:
+        """Get the IDs of images whose QR code is recorded as generated"""
+        return {row[0] for row in self._query("SELECT id FROM images WHERE qr_generated_at IS NOT NULL")}
+
+    def summary(self) -> dict:
+        """Get image and QR code counts and the bytes they use"""
+        images, image_bytes, qr_codes, qr_bytes, downloads = self._query(
+            "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0), COUNT(qr_generated_at), "
+            "COALESCE(SUM(qr_size_bytes), 0), COALESCE(SUM(download_count), 0) FROM images"
+        )[0]
+        return {"images": images, "image_bytes": image_bytes, "qr_codes": qr_codes,
+                "qr_bytes": qr_bytes, "downloads": downloads}
+
+    def append_event(self, kind: str, data: dict, origin: int) -> int:
+        """Add an event to the log shared by the worker processes; returns its sequence number"""
+        with self._lock:
+            return self._connect().execute(
+                "INSERT INTO events (created_at, origin, kind, data) VALUES (?, ?, ?, ?)",
+                (time.time(), origin, kind, json.dumps(data))
+            ).lastrowid
+
+    def events_after(self, seq: int, limit: int = 500) -> list:
+        """Get (seq, origin, kind, data) for the events logged after seq, oldest first"""
+        rows = self._query("SELECT seq, origin, kind, data FROM events WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit))
+        return [(seq, origin, kind, json.loads(data)) for seq, origin, kind, data in rows]
+
+    def last_event_seq(self) -> int:
+        return self._query("SELECT COALESCE(MAX(seq), 0) FROM events")[0][0]
+
+    def prune_events(self, before: float) -> int:
+        """Drop events logged before a timestamp; returns how many were dropped"""
+        return self._execute("DELETE FROM events WHERE created_at < ?", (before,))
+
+    def save_job(self, job: dict, keep: int = None):
+        """Insert or update an upload job record, keeping only the latest `keep` records"""
+        self._execute(
+            "INSERT OR REPLACE INTO jobs (id, status, image_id, error, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job["job_id"], job["status"], job["image_id"], job["error"], job["created_at"], job["updated_at"])
+        )
+        if keep:
+            self._execute("DELETE FROM jobs WHERE id NOT IN (SELECT id FROM jobs ORDER BY updated_at DESC LIMIT ?)", (keep,))
+
+    def get_job(self, job_id: str):
+        """Get an upload job record, or None if the job is unknown"""
+        rows = self._query("SELECT id, status, image_id, error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,))
+        if not rows:
+            return None
+        return dict(zip(["job_id", "status", "image_id", "error", "created_at", "updated_at"], rows[0]))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+metadata_store = MetadataStore()
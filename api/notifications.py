@@ -0,0 +1,105 @@
+import os
+import json
+import asyncio
+from collections import deque
+from dotenv import load_dotenv
+
+
+load_dotenv(verbose=True, override=True)
+
+SUBSCRIBER_QUEUE_SIZE = 16  # Events buffered per client before the oldest is dropped
+RECENT_EVENT_IDS = 256  # Image IDs remembered to avoid announcing the same image twice
+
+
+class ImageEventBroker:
+    """Fans out new-image events to every connected Server-Sent Events client.
+
+    Each event is serialized once and the same payload is pushed to every
+    subscriber queue; a slow client loses its oldest buffered events rather than
+    holding up the others. publish() is safe to call from any thread.
+    """
+
+    def __init__(self, heartbeat: float = None):
+        self.heartbeat = heartbeat if heartbeat is not None else float(os.getenv("SSE_HEARTBEAT", 15))
+        self._subscribers = set()
+        self._recent = deque(maxlen=RECENT_EVENT_IDS)
+        self._loop = None
+        self.published = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop = None):
+        """Remember the event loop that owns the subscriber queues"""
+        self._loop = loop or asyncio.get_running_loop()
+
+    def subscribe(self) -> asyncio.Queue:
+        if self._loop is None:
+            self.bind()
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def publish(self, image_id: str, event: str = "new-image"):
+        """Announce a committed image to all subscribers (once per image ID)"""
+        if self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._publish(image_id, event)
+        else:
+            self._loop.call_soon_threadsafe(self._publish, image_id, event)
+
+    def publish_batch(self, image_ids: list, event: str = "new-image"):
+        """Announce several committed images with one event carrying the newest (last) ID.
+
+        Call reserve() with the IDs before they are listed so the per-image
+        events raised while they are committed are skipped.
+        """
+        if self._loop is None or not image_ids:
+            return
+        self._loop.call_soon_threadsafe(self._publish, image_ids[-1], event, list(image_ids))
+
+    def reserve(self, image_ids: list):
+        """Treat images as already announced, so publish() skips them"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._recent.extend, image_ids)
+
+    def announced(self, image_id: str) -> bool:
+        """Whether an image was announced recently (call from the event loop)"""
+        return image_id in self._recent
+
+    def _publish(self, image_id: str, event: str, batch: list = None):
+        if batch is None:
+            if image_id in self._recent:
+                return
+            self._recent.append(image_id)
+        self.published += 1
+        data = {"image_id": image_id} if batch is None else {"image_id": image_id, "image_ids": batch}
+        message = f"event: {event}\nid: {image_id}\ndata: {json.dumps(data)}\n\n"
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+
+    async def stream(self, request):
+        """Yield SSE messages for one client until it disconnects"""
+        queue = self.subscribe()
+        try:
+            yield f"retry: {int(self.heartbeat * 1000)}\n\n"
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self.unsubscribe(queue)
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self._subscribers), "published": self.published}
+
+
+image_events = ImageEventBroker()
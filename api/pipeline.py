@@ -0,0 +1,307 @@
+import os
+import io
+import time
+import asyncio
+import multiprocessing
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from dotenv import load_dotenv
+
+from starlette.concurrency import run_in_threadpool
+
+from .constants import WATERMARK_OPTIONS, RENDITION_SIZES, RENDITION_QUALITY, IMG_EXT
+from .services import save_renditions, publish_image, publish_images, delete_renditions, delete_image_unit, get_image_path, new_image_id, generate_qr_code, warm_image_cache, available_rendition_formats
+from functions.watermark_template import WatermarkTemplate, COMPOSITE_REGIONS
+from .storage import atomic_write, temp_path_for, remove_quietly
+from .encoding import jpeg_profile, jpeg_save_options, source_metadata
+from .retention import retention_service
+from .notifications import image_events
+from .cluster import web_workers
+
+
+load_dotenv(verbose=True, override=True)
+
+
+# Compiled once per worker process; reused by every upload that worker handles
+watermark_template = WatermarkTemplate(composite=os.getenv("WATERMARK_COMPOSITE", COMPOSITE_REGIONS).lower(),
+                                       **WATERMARK_OPTIONS)
+
+
+class PipelineBusyError(Exception):
+    """Raised when the watermark pool has no free worker or queue slot"""
+
+
+def flatten_to_rgb(image: Image.Image) -> Image.Image:
+    """Flatten an RGBA image onto a white background (JPEG doesn't support alpha)"""
+    if image.mode != 'RGBA':
+        return image
+    rgb_image = Image.new('RGB', image.size, (255, 255, 255))
+    rgb_image.paste(image, mask=image.split()[-1])  # Use alpha as mask
+    return rgb_image
+
+
+def encode_jpeg(image: Image.Image, options: dict) -> bytes:
+    img_bytes = io.BytesIO()
+    image.save(img_bytes, **options)
+    return img_bytes.getvalue()
+
+
+def make_renditions(image: Image.Image, profile: dict = None, icc_profile: bytes = None) -> dict:
+    """Encode downscaled renditions of an RGB image.
+
+    Returns {size name: {file extension: bytes}} with a JPEG plus every available
+    modern format per size. Sizes are produced largest first, each from the
+    previous one, so every resize works on the smallest source that is still big enough.
+    The JPEGs use RENDITION_QUALITY with the JPEG profile's other encoder
+    settings, and carry icc_profile but no EXIF.
+    """
+    profile = dict(profile or jpeg_profile(), quality=RENDITION_QUALITY)
+    jpeg_options = jpeg_save_options(profile, metadata={"icc_profile": icc_profile} if icc_profile else None)
+    formats = available_rendition_formats()
+    renditions = {}
+    source = image
+    for name, box in sorted(RENDITION_SIZES.items(), key=lambda item: item[1], reverse=True):
+        rendition = source.copy()
+        rendition.thumbnail(box, Image.Resampling.LANCZOS, reducing_gap=3.0)
+        encoded = {IMG_EXT: encode_jpeg(rendition, jpeg_options)}
+        for spec in formats.values():
+            img_bytes = io.BytesIO()
+            rendition.save(img_bytes, format=spec["format"], quality=spec["quality"])
+            encoded[spec["ext"]] = img_bytes.getvalue()
+        renditions[name] = encoded
+        source = rendition
+    return renditions
+
+
+def process_upload(source_path: str, image_id: str, submitted_at: float = None, output_path: str = None):
+    """Watermark, flatten and JPEG-encode an uploaded image and its renditions.
+
+    Runs inside a pool worker process. The raw upload is decoded from
+    source_path and the renditions and the JPEG are written straight to their
+    destination files (via temp file and rename), so the full-size image never
+    crosses the process boundary. Directory fsyncs are left to publish_image.
+    With output_path the JPEG is written there instead of its listed path, for
+    a caller that renames it into place itself. Returns the rendition bytes
+    (for the hot cache), a dict of seconds spent in each stage and the
+    worker's template layout cache hits/misses for this call.
+    """
+    timings = {}
+    hits, misses = watermark_template.hits, watermark_template.misses
+    started = time.time()
+    if submitted_at is not None:
+        timings["queue_wait"] = max(0.0, started - submitted_at)
+
+    max_dimension = int(os.getenv("MAX_IMAGE_DIMENSION", 0)) or None
+    profile = jpeg_profile()
+    source_image = watermark_template.open(source_path, max_dimension)
+    metadata = source_metadata(source_image, profile)
+    watermarked_image = watermark_template.apply(source_image)
+    timings["watermark"] = time.time() - started
+
+    stage_start = time.time()
+    watermarked_image = flatten_to_rgb(watermarked_image)  # Already RGB with region compositing
+    timings["flatten"] = time.time() - stage_start
+
+    # Save renditions first so the image is servable at every size once it is listed
+    stage_start = time.time()
+    renditions = make_renditions(watermarked_image, profile, metadata.get("icc_profile"))
+    save_renditions(image_id, renditions, sync_dir=False)
+    timings["renditions"] = time.time() - stage_start
+
+    stage_start = time.time()
+    atomic_write(output_path or get_image_path(image_id + IMG_EXT), sync_dir=False,
+                 writer=lambda f: watermarked_image.save(f, **jpeg_save_options(profile, watermarked_image, metadata)))
+    timings["encode"] = time.time() - stage_start
+
+    cache_delta = {"hits": watermark_template.hits - hits, "misses": watermark_template.misses - misses}
+    return renditions, timings, cache_delta
+
+
+class WatermarkPool:
+    """Bounded process pool that runs the CPU-bound upload pipeline off the event loop.
+
+    At most max_workers images are processed at once and max_queue more may wait;
+    anything beyond that is rejected with PipelineBusyError so the caller can
+    answer 503 instead of piling work onto the server.
+    """
+
+    def __init__(self, max_workers: int = None, max_queue: int = None):
+        # The CPU cores are shared by the pools of all web workers
+        self.max_workers = max_workers or int(os.getenv("WATERMARK_WORKERS", max(1, (os.cpu_count() or 1) // web_workers())))
+        self.max_queue = max_queue if max_queue is not None else int(os.getenv("WATERMARK_QUEUE_SIZE", 8))
+        self._executor = None
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._failed = 0
+        self._stage_totals = defaultdict(float)
+        self._watermark_layouts = {"hits": 0, "misses": 0}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn avoids forking a process that already runs the server's threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def acquire(self, count: int = 1):
+        """Reserve count pipeline slots at once, raising PipelineBusyError when they are not all free"""
+        if self._in_flight + count > self.capacity:
+            self._rejected += count
+            raise PipelineBusyError(f"Watermark pipeline is saturated ({self._in_flight} in flight)")
+        self._in_flight += count
+
+    def release(self, count: int = 1):
+        self._in_flight -= count
+
+    async def run(self, source_path: str, image_id: str, output_path: str = None, acquired: bool = False):
+        """Run process_upload in the pool and return the rendition bytes once the image is written.
+
+        Pass acquired=True when the slot was already reserved with acquire();
+        it is released either way.
+        """
+        if not acquired:
+            self.acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            renditions, timings, cache_delta = await loop.run_in_executor(
+                self._get_executor(), process_upload, source_path, image_id, time.time(), output_path
+            )
+        except BrokenProcessPool:
+            # A worker died; start a fresh pool on the next submission
+            self._executor = None
+            self._failed += 1
+            raise
+        except Exception:
+            self._failed += 1
+            raise
+        finally:
+            self.release()
+
+        self._completed += 1
+        for stage, seconds in timings.items():
+            self.record_stage(stage, seconds)
+        for counter, value in cache_delta.items():
+            self._watermark_layouts[counter] += value
+        return renditions
+
+    def record_stage(self, stage: str, seconds: float):
+        """Add time spent in a pipeline stage to the metrics"""
+        self._stage_totals[stage] += seconds
+
+    def stats(self) -> dict:
+        """Get queue depth, counters and per-stage timings"""
+        return {
+            "workers": self.max_workers,
+            "queue_capacity": self.max_queue,
+            "in_flight": self._in_flight,
+            "queue_depth": max(0, self._in_flight - self.max_workers),
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "failed": self._failed,
+            "stage_seconds_total": {k: round(v, 4) for k, v in self._stage_totals.items()},
+            "stage_seconds_avg": {
+                k: round(v / self._completed, 4) if self._completed else 0.0
+                for k, v in self._stage_totals.items()
+            },
+            "watermark_layouts": dict(self._watermark_layouts)
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+watermark_pool = WatermarkPool()
+
+
+async def ingest_upload(source_path: str, pool: WatermarkPool = watermark_pool) -> str:
+    """Watermark the raw upload at source_path in the pool and list it; returns the image ID"""
+    image_id = new_image_id()
+    try:
+        renditions = await pool.run(source_path, image_id)
+
+        save_start = time.time()
+        await run_in_threadpool(publish_image, image_id)
+        pool.record_stage("save", time.time() - save_start)
+    except PipelineBusyError:
+        raise  # Nothing was written
+    except Exception:
+        # Don't leave renditions or a JPEG behind without a listing or metadata
+        await run_in_threadpool(delete_image_unit, image_id)
+        raise
+    await run_in_threadpool(warm_image_cache, image_id, None, renditions)
+
+    # Pre-generate the QR so the first gallery view serves it from memory
+    qr_start = time.time()
+    try:
+        await run_in_threadpool(generate_qr_code, image_id)
+    except ValueError as e:
+        print(f"Skipping QR pre-generation: {str(e)}")
+    pool.record_stage("qr", time.time() - qr_start)
+
+    # Old images are evicted by the retention service, not on the upload path
+    await run_in_threadpool(retention_service.on_commit, image_id)
+    return image_id
+
+
+async def ingest_batch(source_paths: list, pool: WatermarkPool = watermark_pool, all_or_nothing: bool = False) -> list:
+    """Watermark several raw uploads in parallel and list them together in order.
+
+    Every file is watermarked at once across the pool's workers into a staging
+    file; only when all of them are done are the successful ones renamed into
+    place and listed, in the order of source_paths, so the gallery never shows
+    part of a batch or orders it by which worker finished first. With
+    all_or_nothing a single failure discards the whole batch. Returns one
+    result per file: {"image_id": ...} or {"error": ...}. Raises
+    PipelineBusyError unless the pool has a free slot for every file.
+    """
+    pool.acquire(len(source_paths))
+    image_ids = [new_image_id() for _ in source_paths]
+    staged_paths = [temp_path_for(get_image_path(image_id + IMG_EXT)) for image_id in image_ids]
+    outcomes = await asyncio.gather(*[
+        pool.run(source_path, image_id, staged_path, acquired=True)
+        for source_path, image_id, staged_path in zip(source_paths, image_ids, staged_paths)
+    ], return_exceptions=True)
+
+    failed = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+    staged = []
+    results = []
+    for image_id, staged_path, outcome in zip(image_ids, staged_paths, outcomes):
+        if isinstance(outcome, BaseException):
+            results.append({"error": f"Error processing image: {str(outcome)}"})
+        elif all_or_nothing and failed:
+            results.append({"error": "Discarded because another image in the batch failed"})
+        else:
+            staged.append((image_id, staged_path, outcome))
+            results.append({"image_id": image_id})
+            continue
+        # Renditions are written straight to their final paths; nothing lists them yet
+        remove_quietly(staged_path)
+        await run_in_threadpool(delete_renditions, image_id)
+
+    # The caller announces the batch once; skip the per-image events its listing raises
+    image_events.reserve([image_id for image_id, _, _ in staged])
+    save_start = time.time()
+    await run_in_threadpool(publish_images, [(image_id, staged_path) for image_id, staged_path, _ in staged])
+    pool.record_stage("save", time.time() - save_start)
+
+    for image_id, _, renditions in staged:
+        await run_in_threadpool(warm_image_cache, image_id, None, renditions)
+        qr_start = time.time()
+        try:
+            await run_in_threadpool(generate_qr_code, image_id)
+        except ValueError as e:
+            print(f"Skipping QR pre-generation: {str(e)}")
+        pool.record_stage("qr", time.time() - qr_start)
+        await run_in_threadpool(retention_service.on_commit, image_id)
+    return results
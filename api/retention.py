@@ -0,0 +1,162 @@
+import os
+import time
+import threading
+from collections import Counter
+from dotenv import load_dotenv
+
+from .constants import IMG_EXT, IMG_QTY, IMG_QTY_BUFFER, RETENTION_INTERVAL, RETENTION_LOW_WATERMARK
+from .gallery_index import image_index, qr_index
+from .services import get_image_unit_size, delete_image_unit, delete_qr_file
+
+
+load_dotenv(verbose=True, override=True)
+
+
+class RetentionService:
+    """Background eviction of old images by count, total bytes and age.
+
+    An image is evicted as one unit with its renditions and QR code, oldest
+    first, and the newest image is always kept. Runs every `interval` seconds
+    and as soon as a committed upload pushes the gallery over a limit, so
+    uploads never wait on deletions. A limit of 0 disables that policy.
+    """
+
+    def __init__(self, max_images: int = None, max_bytes: int = None, max_age: float = None, interval: float = None):
+        self.max_images = max_images if max_images is not None else int(os.getenv("RETENTION_MAX_IMAGES", IMG_QTY + IMG_QTY_BUFFER))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("RETENTION_MAX_BYTES", 0))
+        self.max_age = max_age if max_age is not None else float(os.getenv("RETENTION_MAX_AGE", 0))
+        self.interval = interval if interval is not None else float(os.getenv("RETENTION_INTERVAL", RETENTION_INTERVAL))
+        self._sizes = {}  # image ID -> bytes used by the image, its renditions and its QR code
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.last_run = None
+        self.evicted_images = 0
+        self.evicted_bytes = 0
+        self.evicted_orphan_qr_codes = 0
+        self.evictions_by_policy = Counter()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gallery-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def on_commit(self, image_id: str):
+        """Account for a committed upload and wake the service if a limit is exceeded"""
+        if self._thread is None:
+            return  # Not running in this worker; the leader enforces retention (see api.cluster)
+        size = get_image_unit_size(image_id)
+        with self._lock:
+            self._sizes[image_id] = size
+            total = sum(self._sizes.values())
+        if (self.max_images and len(image_index) > self.max_images) or (self.max_bytes and total > self.max_bytes):
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error enforcing retention: {str(e)}")
+
+    def _unit_sizes(self, image_ids: list) -> dict:
+        """Get the bytes used by each image, statting only images not seen before"""
+        with self._lock:
+            known = {image_id: self._sizes[image_id] for image_id in image_ids if image_id in self._sizes}
+        for image_id in image_ids:
+            if image_id not in known:
+                known[image_id] = get_image_unit_size(image_id)
+        with self._lock:
+            self._sizes = known
+        return known
+
+    def select(self, entries: list, sizes: dict, now: float) -> list:
+        """Pick (image ID, policy) pairs to evict from (mtime, image ID) entries, oldest first"""
+        evict = []
+        count = len(entries)
+        total = sum(sizes.values())
+        target_bytes = self.max_bytes * RETENTION_LOW_WATERMARK
+        over_bytes = bool(self.max_bytes) and total > self.max_bytes
+        for mtime, image_id in entries[:-1]:  # Always keep the newest image
+            if self.max_images and count > self.max_images:
+                policy = "count"
+            elif over_bytes and total > target_bytes:
+                policy = "bytes"
+            elif self.max_age and now - mtime > self.max_age:
+                policy = "age"
+            else:
+                break
+            evict.append((image_id, policy))
+            count -= 1
+            total -= sizes.get(image_id, 0)
+        return evict
+
+    def run_once(self) -> dict:
+        """Enforce the retention policies now; returns what was evicted"""
+        with self._run_lock:
+            started = time.time()
+            entries = [(mtime, os.path.splitext(name)[0]) for mtime, name in image_index.entries()]
+            sizes = self._unit_sizes([image_id for _, image_id in entries])
+            evicted = []
+            freed = 0
+            for image_id, policy in self.select(entries, sizes, started):
+                freed += delete_image_unit(image_id)
+                evicted.append(image_id)
+                self.evictions_by_policy[policy] += 1
+                with self._lock:
+                    self._sizes.pop(image_id, None)
+
+            # QR codes whose image is gone, e.g. deleted by hand
+            orphans = 0
+            for name in qr_index.names():
+                if os.path.splitext(name)[0] + IMG_EXT not in image_index:
+                    try:
+                        delete_qr_file(qr_index.path(name))
+                        orphans += 1
+                    except FileNotFoundError:
+                        pass
+
+            self.runs += 1
+            self.last_run = started
+            self.evicted_images += len(evicted)
+            self.evicted_bytes += freed
+            self.evicted_orphan_qr_codes += orphans
+            if evicted or orphans:
+                print(f"Retention evicted {len(evicted)} images ({freed} bytes) and {orphans} orphaned QR codes")
+            return {"evicted_images": evicted, "evicted_bytes": freed, "evicted_orphan_qr_codes": orphans}
+
+    def stats(self) -> dict:
+        with self._lock:
+            tracked_bytes = sum(self._sizes.values())
+        return {
+            "max_images": self.max_images,
+            "max_bytes": self.max_bytes,
+            "max_age_seconds": self.max_age,
+            "interval_seconds": self.interval,
+            "tracked_bytes": tracked_bytes,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "evicted_images": self.evicted_images,
+            "evicted_bytes": self.evicted_bytes,
+            "evicted_orphan_qr_codes": self.evicted_orphan_qr_codes,
+            "evictions_by_policy": dict(self.evictions_by_policy)
+        }
+
+
+retention_service = RetentionService()
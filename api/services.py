@@ -1,112 +1,454 @@
 import os
+import io
+import time
+import threading
+from collections import namedtuple, deque
 from datetime import datetime
 from uuid import uuid4
 import qrcode 
+from PIL import Image
 from dotenv import load_dotenv
 import pytz
-from .constants import IMG_EXT, QR_EXT, IMAGES_DIR, QR_DIR, IMG_QTY, IMG_QTY_BUFFER
+from .constants import IMG_EXT, QR_EXT, IMAGES_DIR, QR_DIR, IMG_QTY, RENDITIONS_DIR, RENDITION_SIZES, RENDITION_FORMATS, ORIGINAL_SIZE, QR_URL_MARKER, QR_CACHE_BYTES, IMAGE_CACHE_BYTES
+from .gallery_index import GalleryIndex, image_index, qr_index
+from .byte_cache import ByteLRUCache
+from .http_cache import make_etag
+from .storage import atomic_write, sync_directory, replace_file
+from .layout import layout_path, base_directory, scan_files
+from .metadata import metadata_store
+from .cluster import cluster_bus
 
 
 load_dotenv(verbose=True, override=True)
 
-def get_image_stats(image_path: str) -> dict:
-    """Get image file name and last modified time"""
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"Image file {image_path} does not exist")
-    
-    last_modified = os.path.getmtime(image_path)
+try:
+    import pillow_avif  # noqa: F401  Registers the AVIF plugin on Pillow versions without native support
+except ImportError:
+    pass
 
-    return {
-        "filename": os.path.basename(image_path),
-        "last_modified": datetime.fromtimestamp(last_modified, tz=pytz.timezone("Asia/Colombo")).strftime('%Y-%m-%d %H:%M:%S'),
-        "size_in_bytes": os.path.getsize(image_path)
-    }
+# Recently served QR PNGs, keyed by (image ID, DEPLOYED_URL)
+qr_cache = ByteLRUCache(int(os.getenv("QR_CACHE_BYTES", QR_CACHE_BYTES)))
+# Encoded bytes of recently uploaded/served images and renditions, keyed by file path
+CachedFile = namedtuple("CachedFile", ["data", "etag", "last_modified", "media_type"])
+image_cache = ByteLRUCache(int(os.getenv("IMAGE_CACHE_BYTES", IMAGE_CACHE_BYTES)), size_of=lambda entry: len(entry.data))
+_qr_url = None  # DEPLOYED_URL the QR directory was last checked against
+_qr_lock = threading.Lock()
+OWN_IMAGE_IDS = 1024  # Image IDs created by this process, remembered so the gallery watcher skips their files
+_own_ids = deque(maxlen=OWN_IMAGE_IDS)
+_own_lock = threading.Lock()
+LOCAL_TZ = pytz.timezone("Asia/Colombo")
 
-def get_qr_stats(qr_path: str) -> dict:
-    """Get QR code file name and last modified time"""
-    if not os.path.exists(qr_path):
-        raise FileNotFoundError(f"QR code file {qr_path} does not exist")
+def format_timestamp(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=LOCAL_TZ).strftime('%Y-%m-%d %H:%M:%S')
 
-    last_modified = os.path.getmtime(qr_path)
+def _scan_sorted(directory: str, ext: str) -> list:
+    """List files with the extension in a directory, newest first (no index)"""
+    return [path for _, path in sorted(((mtime, path) for _, path, mtime in scan_files(directory, ext)), reverse=True)]
 
-    return {
-        "filename": os.path.basename(qr_path),
-        "last_modified": datetime.fromtimestamp(last_modified, tz=pytz.timezone("Asia/Colombo")).strftime('%Y-%m-%d %H:%M:%S'),
-        "size_in_bytes": os.path.getsize(qr_path)
-    }
+def _is_indexed(directory: str, index: GalleryIndex) -> bool:
+    return os.path.normpath(directory) == os.path.normpath(index.directory)
 
-def get_images(images_dir: str = IMAGES_DIR):
-    """Get a path list of all uploaded images"""
-    image_files = sorted(
-        [os.path.join(images_dir, f) for f in os.listdir(images_dir) if f.endswith(IMG_EXT)],
-        key=lambda x: os.path.getmtime(x),
-        reverse=True
-    )
-    return image_files
+def get_images(images_dir: str = IMAGES_DIR, limit: int = None):
+    """Get a path list of all uploaded images (newest first, optionally only the latest `limit`)"""
+    if _is_indexed(images_dir, image_index):
+        return image_index.paths(limit)
+    return _scan_sorted(images_dir, IMG_EXT)[:limit]
 
 def get_qr_files(qr_dir: str = QR_DIR):
     """Get a path list of all generated QR codes"""
-    qr_files = sorted(
-        [os.path.join(qr_dir, f) for f in os.listdir(qr_dir) if f.endswith(QR_EXT)],
-        key=lambda x: os.path.getmtime(x),
-        reverse=True
-    )
-    return qr_files
+    if _is_indexed(qr_dir, qr_index):
+        return qr_index.paths()
+    return _scan_sorted(qr_dir, QR_EXT)
 
 def get_basename_images(images_dir: str = IMAGES_DIR):
     """Get a list of image filenames without paths (latest 20 only)"""
-    image_files = sorted(
-        [os.path.splitext(f)[0] for f in os.listdir(images_dir) if f.endswith(IMG_EXT)],
-        key=lambda x: os.path.getmtime(os.path.join(images_dir, x + IMG_EXT)),
-        reverse=True
-    )[:IMG_QTY]  
-    return image_files
-
-def save_image(image_data: bytes, images_dir: str = IMAGES_DIR) -> str:
-    """Save an image to the images directory"""
-    if not os.path.exists(images_dir):
-        os.makedirs(images_dir)
+    if _is_indexed(images_dir, image_index):
+        return [os.path.splitext(f)[0] for f in image_index.names(IMG_QTY)]
+    return [os.path.splitext(os.path.basename(f))[0] for f in _scan_sorted(images_dir, IMG_EXT)[:IMG_QTY]]
 
+def get_basename_images_since(cursor: str, images_dir: str = IMAGES_DIR):
+    """Get IDs of images saved after the cursor image ID (newest first, at most IMG_QTY).
+
+    Returns None when the cursor is no longer known, so the caller should resync.
+    """
+    if _is_indexed(images_dir, image_index):
+        names = image_index.newer_than(cursor + IMG_EXT, IMG_QTY)
+        return None if names is None else [os.path.splitext(f)[0] for f in names]
+    ids = get_basename_images(images_dir)
+    return ids[:ids.index(cursor)] if cursor in ids else None
+
+def new_image_id() -> str:
+    """Create a new unique image ID, remembered as one this process writes (see is_own_image)"""
     image_id = f"img_{uuid4()}"
-    image_file_name = f"{image_id}{IMG_EXT}"
-    image_path = os.path.join(images_dir, image_file_name)
-    
-    with open(image_path, "wb") as f:
-        f.write(image_data)
-    
-    return str(image_id)
+    with _own_lock:
+        _own_ids.append(image_id)
+    return image_id
+
+def is_own_image(image_id: str) -> bool:
+    """Whether this process created the image ID and so lists and announces the image itself"""
+    with _own_lock:
+        return image_id in _own_ids
+
+def publish_image(image_id: str, images_dir: str = IMAGES_DIR, renditions_dir: str = RENDITIONS_DIR):
+    """List an image renamed into the images directory by a pool worker.
+
+    The directory fsyncs the worker skipped run here, where concurrent uploads
+    share them, so the image is durable before it is announced.
+    """
+    for size in RENDITION_SIZES:
+        sync_directory(os.path.dirname(get_rendition_path(image_id, size, renditions_dir)))
+    sync_directory(os.path.dirname(get_image_path(image_id + IMG_EXT, images_dir)))
+    if _is_indexed(images_dir, image_index):
+        image_index.add(f"{image_id}{IMG_EXT}")
+    record_image(image_id, images_dir)
+
+def publish_images(staged: list, images_dir: str = IMAGES_DIR, renditions_dir: str = RENDITIONS_DIR):
+    """Rename images staged by pool workers into place and list them, in order.
+
+    staged holds (image ID, staged path) pairs. Each image gets a later mtime
+    than the one before it, so the gallery orders a batch by its position
+    rather than by which worker finished first, and all the renames happen
+    before any directory fsync.
+    """
+    now = time.time_ns()
+    for position, (image_id, staged_path) in enumerate(staged):
+        mtime = now + position * 1_000_000
+        os.utime(staged_path, ns=(mtime, mtime))
+        replace_file(staged_path, get_image_path(image_id + IMG_EXT, images_dir), sync_dir=False)
+    for image_id, _ in staged:
+        publish_image(image_id, images_dir, renditions_dir)
+
+def build_image_record(image_id: str, images_dir: str = IMAGES_DIR) -> dict:
+    """Collect the metadata record of a saved image from its files"""
+    image_path = get_image_path(image_id + IMG_EXT, images_dir)
+    stat_result = os.stat(image_path)
+    width = height = None
+    try:
+        with Image.open(image_path) as image:  # Only parses the header
+            width, height = image.size
+    except Exception:
+        pass
+    extensions = [IMG_EXT] + [spec["ext"] for spec in RENDITION_FORMATS.values()]
+    renditions = {}
+    for size in RENDITION_SIZES:
+        for ext in extensions:
+            path = get_rendition_path(image_id, size, ext=ext)
+            if os.path.exists(path):
+                renditions.setdefault(size, {})[ext] = path
+    record = {
+        "id": image_id,
+        "created_at": stat_result.st_mtime,
+        "size_bytes": stat_result.st_size,
+        "width": width,
+        "height": height,
+        "renditions": renditions
+    }
+    try:
+        qr_stat = os.stat(get_qr_path(image_id + QR_EXT))
+        record.update(qr_generated_at=qr_stat.st_mtime, qr_size_bytes=qr_stat.st_size)
+    except FileNotFoundError:
+        pass
+    return record
+
+def record_image(image_id: str, images_dir: str = IMAGES_DIR):
+    """Write the metadata record of an image in the gallery's images directory"""
+    if _is_indexed(images_dir, image_index):
+        metadata_store.upsert(build_image_record(image_id, images_dir))
+
+def _record_qr(qr_path: str):
+    image_id = os.path.splitext(os.path.basename(qr_path))[0]
+    try:
+        stat_result = os.stat(qr_path)
+    except FileNotFoundError:
+        metadata_store.set_qr(image_id)
+        return
+    metadata_store.set_qr(image_id, stat_result.st_mtime, stat_result.st_size)
+
+def apply_index_change(index: GalleryIndex, filename: str, added: bool):
+    """Mirror a file the gallery watcher saw added or removed into the metadata store"""
+    file_id = os.path.splitext(filename)[0]
+    try:
+        if index is image_index:
+            if added:
+                record_image(file_id)
+            else:
+                metadata_store.delete(file_id)
+        elif index is qr_index:
+            _record_qr(index.path(filename))
+    except FileNotFoundError:
+        pass  # Removed again before we got to it
+
+def sync_metadata():
+    """Reconcile the metadata store with the indexed images and QR codes (at startup)"""
+    on_disk = {os.path.splitext(name)[0] for name in image_index.names()}
+    known = metadata_store.ids()
+    for image_id in known - on_disk:
+        metadata_store.delete(image_id)
+    for image_id in on_disk - known:
+        try:
+            record_image(image_id)
+        except FileNotFoundError:
+            pass
+    qr_on_disk = {os.path.splitext(name)[0] for name in qr_index.names()}
+    qr_known = metadata_store.qr_ids()
+    for image_id in (qr_on_disk ^ qr_known) & on_disk:
+        _record_qr(get_qr_path(image_id + QR_EXT))
+
+def get_record_stats(record: dict) -> dict:
+    """Get the /stats entry of an image from its metadata record"""
+    return {
+        "filename": record["id"] + IMG_EXT,
+        "last_modified": format_timestamp(record["created_at"]),
+        "size_in_bytes": record["size_bytes"],
+        "width": record["width"],
+        "height": record["height"],
+        "download_count": record["download_count"]
+    }
+
+def get_record_qr_stats(record: dict) -> dict:
+    """Get the /stats entry of an image's QR code from its metadata record"""
+    return {
+        "filename": record["id"] + QR_EXT,
+        "last_modified": format_timestamp(record["qr_generated_at"]),
+        "size_in_bytes": record["qr_size_bytes"]
+    }
 
 def get_image_path(image_id: str, images_dir: str = IMAGES_DIR) -> str:
     """Get the full path of an image by its ID"""
-    return os.path.join(images_dir, image_id)
+    return layout_path(images_dir, image_id)
+
+def get_rendition_path(image_id: str, size: str, renditions_dir: str = RENDITIONS_DIR, ext: str = IMG_EXT) -> str:
+    """Get the full path of an image rendition by its ID, size name and file extension"""
+    return layout_path(os.path.join(renditions_dir, size), f"{image_id}{ext}")
+
+def available_rendition_formats() -> dict:
+    """Get the entries of RENDITION_FORMATS that the installed Pillow can encode"""
+    Image.init()
+    return {mime: spec for mime, spec in RENDITION_FORMATS.items() if spec["format"] in Image.SAVE}
+
+def accepted_media_types(accept_header: str) -> set:
+    """Get the media types a client explicitly accepts (q > 0) from an Accept header"""
+    accepted = set()
+    for part in (accept_header or "").split(","):
+        media_type, *params = [p.strip() for p in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if media_type and quality > 0:
+            accepted.add(media_type.lower())
+    return accepted
+
+def get_image_candidates(image_id: str, size: str = ORIGINAL_SIZE, accept: str = None) -> list:
+    """Get (path, media type) pairs that could serve an image, best first.
+
+    For renditions, the RENDITION_FORMATS the client accepts come first, then the
+    JPEG rendition; the original image is always the last resort.
+    """
+    candidates = []
+    if size != ORIGINAL_SIZE:
+        accepted = accepted_media_types(accept)
+        for media_type, spec in available_rendition_formats().items():
+            if media_type in accepted:
+                candidates.append((get_rendition_path(image_id, size, ext=spec["ext"]), media_type))
+        candidates.append((get_rendition_path(image_id, size), "image/jpeg"))
+    candidates.append((get_image_path(image_id + IMG_EXT), "image/jpeg"))
+    return candidates
+
+def _read_cached_file(path: str, media_type: str, data: bytes = None) -> CachedFile:
+    stat_result = os.stat(path)
+    if data is None:
+        with open(path, "rb") as f:
+            data = f.read()
+    etag = make_etag(os.path.basename(path), stat_result.st_size, stat_result.st_mtime_ns)
+    return CachedFile(data, etag, stat_result.st_mtime, media_type)
+
+def get_cached_image(path: str, media_type: str):
+    """Get an image file's bytes and validators from the hot image cache, loading it on a miss.
+
+    Returns None if the file does not exist.
+    """
+    entry = image_cache.get(path, count_miss=False)
+    if entry is not None:
+        return entry
+    try:
+        entry = _read_cached_file(path, media_type)
+    except FileNotFoundError:
+        return None
+    image_cache.record_miss()
+    image_cache.put(path, entry)
+    return entry
+
+def warm_image_cache(image_id: str, image_data: bytes = None, renditions: dict = None):
+    """Put a freshly saved image and its renditions into the hot image cache.
+
+    Without image_data the original is left to be cached on its first request.
+    """
+    media_types = {spec["ext"]: media_type for media_type, spec in RENDITION_FORMATS.items()}
+    media_types[IMG_EXT] = "image/jpeg"
+    for size, encoded in (renditions or {}).items():
+        for ext, data in encoded.items():
+            path = get_rendition_path(image_id, size, ext=ext)
+            image_cache.put(path, _read_cached_file(path, media_types[ext], data))
+    if image_data is not None:
+        path = get_image_path(image_id + IMG_EXT)
+        image_cache.put(path, _read_cached_file(path, "image/jpeg", image_data))
+
+def evict_image_cache(image_id: str):
+    """Drop an image and all of its renditions from the hot image cache"""
+    image_cache.discard_where(lambda path: os.path.basename(path).startswith(image_id + "."))
+
+def save_renditions(image_id: str, renditions: dict, renditions_dir: str = RENDITIONS_DIR, sync_dir: bool = True):
+    """Save encoded renditions of an image, given as {size name: {file extension: bytes}}"""
+    for size, encoded in renditions.items():
+        for ext, data in encoded.items():
+            rendition_path = get_rendition_path(image_id, size, renditions_dir, ext)
+            os.makedirs(os.path.dirname(rendition_path), exist_ok=True)
+            atomic_write(rendition_path, data, sync_dir=False)
+        if sync_dir:
+            sync_directory(os.path.dirname(get_rendition_path(image_id, size, renditions_dir)))
+
+def delete_renditions(image_id: str, renditions_dir: str = RENDITIONS_DIR):
+    """Delete every rendition of an image in every format"""
+    extensions = [IMG_EXT] + [spec["ext"] for spec in RENDITION_FORMATS.values()]
+    for size in RENDITION_SIZES:
+        for ext in extensions:
+            try:
+                os.remove(get_rendition_path(image_id, size, renditions_dir, ext))
+            except FileNotFoundError:
+                pass
 
 def get_qr_path(image_id: str, qr_dir: str = QR_DIR) -> str:
     """Get the full path of a QR code image by its ID"""
-    return os.path.join(qr_dir, f"{image_id}")
+    return layout_path(qr_dir, f"{image_id}")
+
+def get_deployed_url() -> str:
+    """Get the public base URL the QR codes point at"""
+    return os.getenv("DEPLOYED_URL", "")
 
-def generate_qr_code(image_id: str, deployed_url: str = os.getenv("DEPLOYED_URL", ""), download_endpoint: str = "/download", qr_dir: str = QR_DIR, qr_ext: str = QR_EXT) -> str:
-    """Generate a QR code pointing to the download URL"""
+def _sync_qr_url(deployed_url: str, qr_dir: str = QR_DIR):
+    """Drop QR codes on disk and in memory that were generated for a different DEPLOYED_URL"""
+    global _qr_url
+    if _qr_url == deployed_url:
+        return
+    with _qr_lock:
+        if _qr_url == deployed_url:
+            return
+        marker_path = os.path.join(qr_dir, QR_URL_MARKER)
+        previous_url = None
+        if os.path.exists(marker_path):
+            with open(marker_path, "r") as f:
+                previous_url = f.read().strip()
+        if previous_url != deployed_url:
+            for qr_path in get_qr_files(qr_dir):
+                try:
+                    delete_qr_file(qr_path)
+                except FileNotFoundError:
+                    pass
+            qr_cache.clear()
+            atomic_write(marker_path, deployed_url.encode())
+        _qr_url = deployed_url
+
+def get_qr_png(image_id: str, deployed_url: str = None, download_endpoint: str = "/download", qr_dir: str = QR_DIR, qr_ext: str = QR_EXT) -> bytes:
+    """Get the PNG bytes of the QR code pointing to the download URL, generating it only once"""
+    deployed_url = deployed_url or get_deployed_url()
     if not deployed_url:
         raise ValueError("DEPLOYED_URL environment variable is not set")
-    qr_path = os.path.join(qr_dir, f"{image_id}{qr_ext}")
-
-    # Avoid regenerating if already exists
-    # if not os.path.exists(qr_path):
-    download_url = f"{deployed_url}{download_endpoint}/{image_id}"
-    qr_img = qrcode.make(download_url)
-    with open(qr_path, "wb") as qr_file:
-        qr_img.save(qr_file)
-    return qr_path
-
-def delete_old_images(images_dir: str = IMAGES_DIR, img_qty: int = IMG_QTY, img_qty_buffer: int = IMG_QTY_BUFFER):
-    """Delete old images to maintain a maximum number of images"""
-    image_files = get_images(images_dir)
-    qr_files = get_qr_files(QR_DIR)
-    if len(image_files) > img_qty + img_qty_buffer:
-        for file_path in image_files[img_qty + img_qty_buffer:]:
-            os.remove(file_path)
-            print(f"Deleted old image: {file_path}")
-    if len(qr_files) > img_qty + img_qty_buffer:
-        for file_path in qr_files[img_qty + img_qty_buffer:]:
-            os.remove(file_path)
-            print(f"Deleted old QR code: {file_path}")
\ No newline at end of file
+    _sync_qr_url(deployed_url, qr_dir)
+
+    cache_key = (image_id, deployed_url)
+    png = qr_cache.get(cache_key)
+    if png is not None:
+        return png
+
+    qr_path = get_qr_path(f"{image_id}{qr_ext}", qr_dir)
+    if os.path.exists(qr_path):
+        with open(qr_path, "rb") as qr_file:
+            png = qr_file.read()
+    else:
+        download_url = f"{deployed_url}{download_endpoint}/{image_id}"
+        qr_bytes = io.BytesIO()
+        qrcode.make(download_url).save(qr_bytes)
+        png = qr_bytes.getvalue()
+        atomic_write(qr_path, png)
+        if _is_indexed(qr_dir, qr_index):
+            qr_index.add(os.path.basename(qr_path))
+            metadata_store.set_qr(image_id, time.time(), len(png))
+    qr_cache.put(cache_key, png)
+    return png
+
+def generate_qr_code(image_id: str, deployed_url: str = None, download_endpoint: str = "/download", qr_dir: str = QR_DIR, qr_ext: str = QR_EXT) -> str:
+    """Generate a QR code pointing to the download URL (if not generated already)"""
+    get_qr_png(image_id, deployed_url, download_endpoint, qr_dir, qr_ext)
+    return get_qr_path(f"{image_id}{qr_ext}", qr_dir)
+
+def delete_image_file(image_path: str):
+    """Delete an image file and its renditions and drop it from the gallery index and caches"""
+    image_id = os.path.splitext(os.path.basename(image_path))[0]
+    evict_image_cache(image_id)
+    try:
+        os.remove(image_path)
+    finally:
+        delete_renditions(image_id)
+        if _is_indexed(base_directory(image_path), image_index):
+            image_index.remove(os.path.basename(image_path))
+            metadata_store.delete(image_id)
+            cluster_bus.publish("evict-image", {"image_id": image_id})
+
+def delete_qr_file(qr_path: str):
+    """Delete a QR code file and drop it from the QR index and cache"""
+    image_id = os.path.splitext(os.path.basename(qr_path))[0]
+    qr_cache.discard_where(lambda key: key[0] == image_id)
+    try:
+        os.remove(qr_path)
+    finally:
+        if _is_indexed(base_directory(qr_path), qr_index):
+            qr_index.remove(os.path.basename(qr_path))
+            metadata_store.set_qr(image_id)
+            cluster_bus.publish("evict-qr", {"image_id": image_id})
+
+def _on_image_evicted(data: dict):
+    # Deleted by another worker: drop it here too without waiting for the gallery watcher
+    evict_image_cache(data["image_id"])
+    image_index.remove(data["image_id"] + IMG_EXT)
+
+def _on_qr_evicted(data: dict):
+    qr_cache.discard_where(lambda key: key[0] == data["image_id"])
+    qr_index.remove(data["image_id"] + QR_EXT)
+
+cluster_bus.on("evict-image", _on_image_evicted)
+cluster_bus.on("evict-qr", _on_qr_evicted)
+
+def get_image_unit_paths(image_id: str) -> list:
+    """Get the paths of every file kept for an image: the original, its renditions and its QR code"""
+    extensions = [IMG_EXT] + [spec["ext"] for spec in RENDITION_FORMATS.values()]
+    paths = [get_image_path(image_id + IMG_EXT), get_qr_path(image_id + QR_EXT)]
+    for size in RENDITION_SIZES:
+        paths.extend(get_rendition_path(image_id, size, ext=ext) for ext in extensions)
+    return paths
+
+def get_image_unit_size(image_id: str) -> int:
+    """Get the bytes on disk used by an image, its renditions and its QR code"""
+    total = 0
+    for path in get_image_unit_paths(image_id):
+        try:
+            total += os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+    return total
+
+def delete_image_unit(image_id: str) -> int:
+    """Delete an image together with its renditions and QR code; returns the bytes freed"""
+    freed = get_image_unit_size(image_id)
+    try:
+        delete_image_file(get_image_path(image_id + IMG_EXT))
+    except FileNotFoundError:
+        pass
+    try:
+        delete_qr_file(get_qr_path(image_id + QR_EXT))
+    except FileNotFoundError:
+        pass
+    return freed
@@ -0,0 +1,167 @@
+import os
+import time
+import threading
+from uuid import uuid4
+from dotenv import load_dotenv
+
+from .constants import TEMP_EXT
+from .layout import shard_directories
+
+
+load_dotenv(verbose=True, override=True)
+
+# GALLERY_FSYNC policies
+FSYNC_OFF = "off"  # Rename only; a power loss may lose recent files but never exposes partial ones
+FSYNC_FILE = "file"  # fsync file contents before the rename
+FSYNC_FULL = "full"  # Also fsync the directory so the rename itself is durable
+STALE_TEMP_SECONDS = 600  # Temp files older than this are leftovers from an interrupted write
+
+
+def fsync_policy() -> str:
+    return os.getenv("GALLERY_FSYNC", FSYNC_FILE).lower()
+
+
+def temp_path_for(path: str) -> str:
+    """Get a unique hidden temp path next to path; it never ends in the final file's extension"""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f".{name}.{uuid4().hex}{TEMP_EXT}")
+
+
+def fsync_file(f):
+    """Flush an open file to disk unless GALLERY_FSYNC is off"""
+    f.flush()
+    if fsync_policy() != FSYNC_OFF:
+        os.fsync(f.fileno())
+
+
+def _fsync_directory(directory: str):
+    if os.name == "nt":
+        return  # Directories cannot be opened for fsync on Windows
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _DirectoryState:
+    def __init__(self, lock: threading.Lock):
+        self.requested = 0  # Tickets handed out
+        self.synced = 0  # Every ticket up to this one is durable
+        self.running = False
+        self.done = threading.Condition(lock)
+
+
+class DirectorySyncer:
+    """Group commit for directory fsyncs.
+
+    Each caller takes a ticket after its rename. One caller at a time runs the
+    fsync and it covers every ticket issued before it started, so a burst of
+    N renames into a directory costs a couple of fsyncs instead of N.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirs = {}
+        self.requests = 0
+        self.syncs = 0
+
+    def sync(self, directory: str):
+        """Block until every rename made in directory before this call is durable"""
+        directory = os.path.normpath(directory or ".")
+        with self._lock:
+            state = self._dirs.get(directory)
+            if state is None:
+                state = self._dirs[directory] = _DirectoryState(self._lock)
+            state.requested += 1
+            self.requests += 1
+            ticket = state.requested
+            while state.synced < ticket:
+                if state.running:
+                    state.done.wait()
+                    continue
+                state.running = True
+                target = state.requested
+                self._lock.release()
+                try:
+                    _fsync_directory(directory)
+                finally:
+                    self._lock.acquire()
+                    state.running = False
+                    state.done.notify_all()
+                state.synced = max(state.synced, target)
+                self.syncs += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"policy": fsync_policy(), "directory_sync_requests": self.requests, "directory_syncs": self.syncs}
+
+
+directory_syncer = DirectorySyncer()
+
+
+def sync_directory(directory: str):
+    """Make renames in directory durable when GALLERY_FSYNC is full"""
+    if fsync_policy() == FSYNC_FULL:
+        directory_syncer.sync(directory)
+
+
+def replace_file(temp_path: str, path: str, sync_dir: bool = True):
+    """Atomically move a fully written temp file to its final path"""
+    try:
+        os.replace(temp_path, path)
+    except BaseException:
+        remove_quietly(temp_path)
+        raise
+    if sync_dir:
+        sync_directory(os.path.dirname(path))
+
+
+def atomic_write(path: str, data: bytes = None, writer=None, sync_dir: bool = True):
+    """Write a file through a temp file and a rename so readers never see it partially written.
+
+    Pass the bytes as data, or a writer(f) callable that writes to the open
+    file. With sync_dir=False the directory fsync is left to the caller (see
+    sync_directory), e.g. to batch it with other files.
+    """
+    temp_path = temp_path_for(path)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        with open(temp_path, "wb") as f:
+            if writer is not None:
+                writer(f)
+            else:
+                f.write(data)
+            fsync_file(f)
+    except BaseException:
+        remove_quietly(temp_path)
+        raise
+    replace_file(temp_path, path, sync_dir)
+
+
+def remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_stale_temp_files(directories: list, max_age: float = STALE_TEMP_SECONDS) -> int:
+    """Delete temp files left behind by interrupted writes; returns how many were removed"""
+    removed = 0
+    cutoff = time.time() - max_age
+    for directory in directories:
+        for candidate in [directory] + shard_directories(directory):
+            if os.path.isdir(candidate):
+                removed += _remove_stale_temp_files(candidate, cutoff)
+    return removed
+
+
+def _remove_stale_temp_files(directory: str, cutoff: float) -> int:
+    removed = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.startswith(".") and entry.name.endswith(TEMP_EXT) and entry.stat().st_mtime < cutoff:
+                remove_quietly(entry.path)
+                removed += 1
+    return removed
@@ -0,0 +1,287 @@
+import io
+import os
+from PIL import Image
+from dotenv import load_dotenv
+from fastapi import Request
+from starlette.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+from .constants import MAX_UPLOAD_BYTES, MAX_UPLOAD_PIXELS, UPLOAD_HEADER_BYTES
+from .storage import temp_path_for, fsync_file, replace_file, remove_quietly
+
+
+load_dotenv(verbose=True, override=True)
+
+# Leading bytes of the formats accepted by /upload
+UPLOAD_SIGNATURES = {
+    b"\xff\xd8\xff": "JPEG",
+    b"\x89PNG\r\n\x1a\n": "PNG",
+    b"RIFF": "WEBP"  # Followed by the size and b"WEBP", checked in sniff_format
+}
+
+
+class UploadRejected(Exception):
+    """Raised when an upload is refused; status_code is the HTTP status to answer with"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+
+
+def max_upload_bytes() -> int:
+    return int(os.getenv("MAX_UPLOAD_BYTES", MAX_UPLOAD_BYTES))
+
+
+def max_upload_pixels() -> int:
+    return int(os.getenv("MAX_UPLOAD_PIXELS", MAX_UPLOAD_PIXELS))
+
+
+def sniff_format(head: bytes):
+    """Get the image format from the magic bytes at the start of a file, or None"""
+    for signature, image_format in UPLOAD_SIGNATURES.items():
+        if head.startswith(signature):
+            if image_format == "WEBP" and head[8:12] != b"WEBP":
+                return None
+            return image_format
+    return None
+
+
+def check_dimensions(source, complete: bool = True):
+    """Read the image size from the header only and enforce MAX_UPLOAD_PIXELS.
+
+    Returns (width, height), or None when the header is incomplete and the
+    check has to wait for the rest of the file.
+    """
+    try:
+        with Image.open(source) as image:
+            width, height = image.size
+    except Image.DecompressionBombError as e:
+        raise UploadRejected(413, str(e))
+    except Exception:
+        if not complete:
+            return None
+        raise UploadRejected(415, "Uploaded file is not a readable image")
+    if width * height > max_upload_pixels():
+        raise UploadRejected(413, f"Image is {width}x{height}, larger than {max_upload_pixels()} pixels")
+    return width, height
+
+
+class _FileParts:
+    """Multipart parser callbacks that keep the bodies of one (possibly repeated) form field and skip the rest"""
+
+    def __init__(self, boundary: bytes, field_name: str, max_parts: int = 1):
+        self.field_name = field_name
+        self.max_parts = max_parts
+        self.filenames = []  # One per kept part, in request order
+        self.completed = set()  # Indexes of kept parts whose body has ended
+        self.extra = 0  # Parts of the field beyond max_parts, skipped
+        self.pending = []  # (part index, body chunk) parsed but not yet written
+        self._current = None
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("latin-1")
+        self._current = None
+        if name != self.field_name:
+            return
+        if len(self.filenames) >= self.max_parts:
+            self.extra += 1
+            return
+        filename = options.get(b"filename")
+        self._current = len(self.filenames)
+        self.filenames.append(filename.decode("utf-8", "replace") if filename else None)
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._current is None:
+            return
+        if self.pending and self.pending[-1][0] == self._current:
+            self.pending[-1][1].append(data[start:end])
+        else:
+            self.pending.append((self._current, [data[start:end]]))
+
+    def _on_part_end(self):
+        if self._current is not None:
+            self.completed.add(self._current)
+            self._current = None
+
+    def take(self) -> list:
+        """Get the (part index, bytes) parsed since the last call"""
+        data = [(index, b"".join(chunks)) for index, chunks in self.pending]
+        self.pending.clear()
+        return data
+
+
+class _IncomingFile:
+    """One file part being streamed to a temp file next to its destination"""
+
+    def __init__(self, filename: str, dest_path: str, durable: bool = False):
+        self.filename = filename
+        self.dest_path = dest_path
+        self.durable = durable
+        self.temp_path = temp_path_for(dest_path)
+        self.error = None  # UploadRejected once the file is refused
+        self.image_format = None
+        self.size = None
+        self.bytes = 0
+        self._f = None
+        self._head = b""
+        self._header_checked = False
+
+    async def write(self, data: bytes, limit: int, complete: bool):
+        """Append body bytes, checking the size limit and, from the leading bytes, format and dimensions"""
+        self.bytes += len(data)
+        if self.bytes > limit:
+            raise UploadRejected(413, f"Upload is larger than {limit} bytes")
+        if not self._header_checked:
+            self._head += data[:UPLOAD_HEADER_BYTES - len(self._head)]
+            self.image_format = self.image_format or sniff_format(self._head[:12])
+            if self.image_format is None and len(self._head) >= 12:
+                raise UploadRejected(415, "Unsupported image format, expected JPEG, PNG or WebP")
+            if len(self._head) >= UPLOAD_HEADER_BYTES or complete:
+                self.size = check_dimensions(io.BytesIO(self._head), complete=complete)
+                self._header_checked = True
+                self._head = b""
+        if self._f is None:
+            self._f = await run_in_threadpool(open, self.temp_path, "wb")
+        await run_in_threadpool(self._f.write, data)
+
+    async def finish(self) -> dict:
+        """Flush the file, finish validating it and rename it to its destination"""
+        if self._f is not None:
+            if self.durable:
+                await run_in_threadpool(fsync_file, self._f)
+            await run_in_threadpool(self._f.close)
+            self._f = None
+        if self.image_format is None:
+            raise UploadRejected(415, "Unsupported image format, expected JPEG, PNG or WebP")
+        if self.size is None:
+            # Small uploads and headers longer than UPLOAD_HEADER_BYTES are checked from disk
+            self.size = await run_in_threadpool(check_dimensions, self.temp_path)
+        await run_in_threadpool(replace_file, self.temp_path, self.dest_path)
+        return {"filename": self.filename, "format": self.image_format,
+                "width": self.size[0], "height": self.size[1], "bytes": self.bytes}
+
+    async def discard(self):
+        if self._f is not None:
+            await run_in_threadpool(self._f.close)
+            self._f = None
+        remove_quietly(self.temp_path)
+
+
+async def stream_uploads(request: Request, dest_paths: list, field_name: str = "files",
+                         fail_fast: bool = False, reject_extra: bool = True, durable: bool = False) -> list:
+    """Stream every file field of a multipart upload to its own path in dest_paths.
+
+    The request body is never held in memory: each file gets the
+    MAX_UPLOAD_BYTES limit while reading, and its magic bytes and dimensions
+    are checked from its first UPLOAD_HEADER_BYTES. Each file goes to a temp
+    file that is renamed to its destination once complete, so a queued job
+    never picks up a partial upload. With durable it is fsynced first (per
+    GALLERY_FSYNC), for files that must survive a restart. Returns one dict
+    per file in request order: its info, or its filename, status_code and
+    error when it was refused. With fail_fast the first refused file aborts
+    the whole upload instead. Raises UploadRejected when the request itself
+    is refused, including (with reject_extra) when it has more files than
+    dest_paths.
+    """
+    file_limit = max_upload_bytes()
+    body_limit = file_limit * len(dest_paths)
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > body_limit:
+        raise UploadRejected(413, f"Upload is larger than {body_limit} bytes")
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise UploadRejected(400, "Expected a multipart/form-data upload")
+
+    parts = _FileParts(options[b"boundary"], field_name, len(dest_paths))
+    files = []
+
+    async def write_parsed():
+        while len(files) < len(parts.filenames):
+            files.append(_IncomingFile(parts.filenames[len(files)], dest_paths[len(files)], durable))
+        if reject_extra and parts.extra:
+            raise UploadRejected(413, f"At most {len(dest_paths)} '{field_name}' files per upload")
+        for index, data in parts.take():
+            incoming = files[index]
+            if incoming.error is not None:
+                continue
+            try:
+                await incoming.write(data, file_limit, index in parts.completed)
+            except UploadRejected as e:
+                if fail_fast:
+                    raise
+                incoming.error = e
+                await incoming.discard()
+
+    results = []
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > body_limit:
+                raise UploadRejected(413, f"Upload is larger than {body_limit} bytes")
+            parts.parser.write(chunk)
+            await write_parsed()
+        parts.parser.finalize()
+        await write_parsed()
+        for incoming in files:
+            if incoming.error is None:
+                try:
+                    results.append(await incoming.finish())
+                    continue
+                except UploadRejected as e:
+                    if fail_fast:
+                        raise
+                    incoming.error = e
+                    await incoming.discard()
+            results.append({"filename": incoming.filename, "status_code": incoming.error.status_code,
+                            "error": str(incoming.error)})
+    except BaseException:
+        for incoming in files:
+            await incoming.discard()
+        raise
+    return results
+
+
+async def stream_upload(request: Request, dest_path: str, field_name: str = "file", durable: bool = False) -> dict:
+    """Stream the file field of a multipart upload straight to dest_path.
+
+    The size limit is enforced while reading and a bad upload is refused from
+    its leading bytes before the rest is read (see stream_uploads). Later
+    parts of the same field are ignored. Raises UploadRejected when the
+    upload is refused.
+    """
+    results = await stream_uploads(request, [dest_path], field_name, fail_fast=True, reject_extra=False, durable=durable)
+    if not results:
+        raise UploadRejected(400, f"Missing '{field_name}' file field")
+    return results[0]
@@ -0,0 +1,196 @@
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from dotenv import load_dotenv
+
+from .gallery_index import GalleryIndex, image_index, qr_index
+from .layout import scan_files, ensure_layout, shard_directories, storage_layout, HASHED_LAYOUT
+
+
+load_dotenv(verbose=True, override=True)
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, "O_CLOEXEC", 0o2000000)
+
+ADD_MASK = IN_CLOSE_WRITE | IN_MOVED_TO
+REMOVE_MASK = IN_DELETE | IN_MOVED_FROM
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class InotifyUnavailable(Exception):
+    """Raised when the platform does not provide inotify"""
+
+
+class _Inotify:
+    """Minimal ctypes binding for the inotify calls the watcher needs"""
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise InotifyUnavailable(f"inotify is not available on {sys.platform}")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise InotifyUnavailable("libc does not provide inotify_init1")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def read_events(self, timeout: float) -> list:
+        """Return (wd, mask, name) tuples, waiting at most timeout seconds"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class GalleryWatcher:
+    """Keeps gallery indexes in step with files added or removed outside this process.
+
+    Uses inotify where available and falls back to polling the directories every
+    `interval` seconds. Listeners registered with add_listener are called with
+    (index, filename, added) for every change applied to an index. Files for
+    which is_own_file(filename) is true are written by this process, which
+    indexes them itself once they are published, so their arrival is ignored.
+    """
+
+    def __init__(self, indexes: list, mode: str = None, interval: float = None):
+        self.indexes = indexes
+        self.mode = (mode or os.getenv("GALLERY_WATCHER", "auto")).lower()
+        self.interval = interval if interval is not None else float(os.getenv("GALLERY_WATCH_INTERVAL", 2))
+        self.backend = None
+        self._listeners = []
+        self.is_own_file = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def start(self):
+        if self.mode == "off" or self._thread is not None:
+            return
+        inotify = None
+        if self.mode in ("auto", "inotify"):
+            try:
+                inotify = _Inotify()
+            except InotifyUnavailable as e:
+                if self.mode == "inotify":
+                    raise
+                print(f"inotify unavailable ({str(e)}), polling gallery directories instead")
+        self.backend = "inotify" if inotify else "polling"
+        target = self._run_inotify if inotify else self._run_polling
+        self._stop.clear()
+        self._thread = threading.Thread(target=target, args=(inotify,) if inotify else (), name="gallery-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def _apply(self, index: GalleryIndex, filename: str, added: bool):
+        if not filename.endswith(index.ext):
+            return
+        if added:
+            if self.is_own_file and self.is_own_file(filename):
+                return
+            try:
+                index.add(filename)
+            except FileNotFoundError:
+                return  # Removed again before we got to it
+        elif filename in index:
+            index.remove(filename)
+        else:
+            return
+        for callback in self._listeners:
+            try:
+                callback(index, filename, added)
+            except Exception as e:
+                print(f"Gallery watcher listener failed: {str(e)}")
+
+    def _resync(self, index: GalleryIndex):
+        """Diff the directory against the index and apply the changes"""
+        on_disk = {name: mtime for name, _, mtime in scan_files(index.directory, index.ext)}
+        for filename in set(index.names()) - on_disk.keys():
+            self._apply(index, filename, added=False)
+        for filename, mtime in on_disk.items():
+            if index.mtime(filename) != mtime:
+                self._apply(index, filename, added=True)
+
+    def _run_polling(self):
+        while not self._stop.wait(self.interval):
+            for index in self.indexes:
+                try:
+                    self._resync(index)
+                except OSError as e:
+                    print(f"Error polling {index.directory}: {str(e)}")
+
+    def _run_inotify(self, inotify: _Inotify):
+        watches = {}
+        try:
+            for index in self.indexes:
+                ensure_layout(index.directory)
+                directories = [index.directory]
+                if storage_layout() == HASHED_LAYOUT:
+                    directories = shard_directories(index.directory)
+                for directory in directories:
+                    watches[inotify.add_watch(directory, ADD_MASK | REMOVE_MASK | IN_DELETE_SELF)] = index
+                # Catch anything that changed between the initial load and the watch
+                self._resync(index)
+            while not self._stop.is_set():
+                for wd, mask, name in inotify.read_events(timeout=1.0):
+                    if mask & IN_Q_OVERFLOW:
+                        for index in self.indexes:
+                            self._resync(index)
+                        continue
+                    index = watches.get(wd)
+                    if index is None or mask & (IN_ISDIR | IN_IGNORED) or not name:
+                        continue
+                    self._apply(index, name, added=bool(mask & ADD_MASK))
+        except OSError as e:
+            print(f"inotify watcher failed ({str(e)}), falling back to polling")
+            self.backend = "polling"
+            self._run_polling()
+        finally:
+            inotify.close()
+
+
+gallery_watcher = GalleryWatcher([image_index, qr_index])
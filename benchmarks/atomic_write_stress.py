@@ -0,0 +1,136 @@
+"""
+Stress concurrent image writers against gallery readers.
+
+Writer threads save files into a scratch directory while reader threads list it
+newest-first by mtime (as get_images does without the index) and read every
+listed file back, checking a SHA-256 trailer. "direct" writes in place as
+uploads once were; "atomic" goes through api.storage.atomic_write (temp file,
+fsync policy, rename). Torn reads should only ever show up for "direct".
+
+Each GALLERY_FSYNC policy is timed separately; with "full", directory_syncs
+below directory_sync_requests shows the group commit batching directory fsyncs.
+
+Usage:
+    python benchmarks/atomic_write_stress.py [--writers 8] [--readers 8] [--files 200] [--size-kb 512]
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api import storage
+
+EXT = ".jpg"
+
+
+def make_payload(size: int) -> bytes:
+    body = os.urandom(size)
+    return body + hashlib.sha256(body).digest()
+
+
+def is_complete(data: bytes) -> bool:
+    return len(data) > 32 and hashlib.sha256(data[:-32]).digest() == data[-32:]
+
+
+def write_direct(path: str, data: bytes):
+    with open(path, "wb") as f:
+        half = len(data) // 2
+        f.write(data[:half])
+        f.flush()  # Make the half-written state visible to readers, as a slow encoder would
+        f.write(data[half:])
+
+
+def list_newest(directory: str) -> list:
+    paths = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(EXT)]
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            pass
+    return [path for _, path in sorted(mtimes, reverse=True)]
+
+
+def run(mode: str, policy: str, args) -> dict:
+    os.environ["GALLERY_FSYNC"] = policy
+    directory = tempfile.mkdtemp(prefix="atomic_stress_", dir=".")
+    storage.directory_syncer = storage.DirectorySyncer()
+    payload = make_payload(args.size_kb * 1024)
+    write = write_direct if mode == "direct" else storage.atomic_write
+    done = threading.Event()
+    counts = {"reads": 0, "torn": 0}
+    lock = threading.Lock()
+
+    def writer(worker: int):
+        for i in range(args.files):
+            write(os.path.join(directory, f"img_{worker}_{i}{EXT}"), payload)
+
+    def reader():
+        reads = torn = 0
+        while not done.is_set():
+            for path in list_newest(directory)[:5]:
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    continue
+                reads += 1
+                torn += not is_complete(data)
+        with lock:
+            counts["reads"] += reads
+            counts["torn"] += torn
+
+    readers = [threading.Thread(target=reader) for _ in range(args.readers)]
+    writers = [threading.Thread(target=writer, args=(w,)) for w in range(args.writers)]
+    for thread in readers:
+        thread.start()
+    start = time.perf_counter()
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    for thread in readers:
+        thread.join()
+
+    leftovers = [f for f in os.listdir(directory) if f.endswith(storage.TEMP_EXT)]
+    shutil.rmtree(directory)
+    syncs = storage.directory_syncer.stats()
+    return {
+        "files_per_s": args.writers * args.files / elapsed,
+        "reads": counts["reads"],
+        "torn": counts["torn"],
+        "temp_leftovers": len(leftovers),
+        "dir_sync_requests": syncs["directory_sync_requests"],
+        "dir_syncs": syncs["directory_syncs"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--files", type=int, default=200, help="Files written per writer")
+    parser.add_argument("--size-kb", type=int, default=512)
+    args = parser.parse_args()
+
+    scenarios = [("direct", storage.FSYNC_OFF)] + [("atomic", p) for p in (storage.FSYNC_OFF, storage.FSYNC_FILE, storage.FSYNC_FULL)]
+    print(f"{'mode':<8} {'fsync':<6} {'files/s':>9} {'reads':>8} {'torn':>6} {'temp left':>10} {'dir sync req':>13} {'dir syncs':>10}")
+    failed = False
+    for mode, policy in scenarios:
+        result = run(mode, policy, args)
+        print(f"{mode:<8} {policy:<6} {result['files_per_s']:>9.1f} {result['reads']:>8} {result['torn']:>6} "
+              f"{result['temp_leftovers']:>10} {result['dir_sync_requests']:>13} {result['dir_syncs']:>10}")
+        failed |= mode == "atomic" and (result["torn"] > 0 or result["temp_leftovers"] > 0)
+    if failed:
+        sys.exit("Atomic writes exposed partial files")
+
+
+if __name__ == "__main__":
+    main()
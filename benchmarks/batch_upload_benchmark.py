@@ -0,0 +1,111 @@
+"""
+Benchmark /upload/batch throughput against the number of watermark workers.
+
+Runs ingest_batch, the pipeline behind /upload/batch, on a batch of synthetic
+JPEG photos with pools of 1, 2, 4, ... workers up to the CPU count, and
+reports images per second and the speedup over a single worker. Each image is
+watermarked, encoded with its renditions, listed and deleted again. Everything
+is written under a temporary directory, which becomes the working directory
+(with static/ linked in for the watermark assets) so images/, qr/, incoming/
+and the metadata database never touch the live gallery, also in the spawned
+pool workers. Run from the repository root on Linux or macOS.
+
+Usage:
+    python benchmarks/batch_upload_benchmark.py [--batch 16] [--size 3024x4032] [--workers 1 2 4 8]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+if __name__ == "__main__":
+    # The gallery directories are relative to the working directory (and created on import).
+    # Pool workers re-import this script as __mp_main__ and inherit the directory instead
+    SCRATCH = tempfile.TemporaryDirectory(prefix="batch_bench_")
+    os.symlink(os.path.join(ROOT, "static"), os.path.join(SCRATCH.name, "static"))
+    os.chdir(SCRATCH.name)
+from api.pipeline import WatermarkPool, ingest_batch
+from api.services import delete_image_unit
+from api.metadata import metadata_store
+
+metadata_store.path = os.path.abspath("gallery.db")  # Even if .env sets METADATA_DB
+
+
+def make_jpeg(path, size):
+    """Write a synthetic JPEG photo of the given size"""
+    image = Image.radial_gradient('L').resize(size).convert('RGB')
+    image.save(path, format='JPEG', quality=95)
+
+
+def default_workers():
+    counts = []
+    workers = 1
+    while workers < (os.cpu_count() or 1):
+        counts.append(workers)
+        workers *= 2
+    return counts + [os.cpu_count() or 1]
+
+
+async def run_batch(paths, workers):
+    pool = WatermarkPool(max_workers=workers, max_queue=len(paths))
+    try:
+        # Warm-up: start the worker processes and fill their overlay caches
+        await ingest_batch_quietly(paths[:workers], pool)
+        start = time.perf_counter()
+        await ingest_batch_quietly(paths, pool)
+        return time.perf_counter() - start
+    finally:
+        pool.shutdown()
+
+
+async def ingest_batch_quietly(paths, pool):
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = await ingest_batch(paths, pool)
+    for result in results:
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        delete_image_unit(result["image_id"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=16, help="Images per batch")
+    parser.add_argument("--size", default="3024x4032", help="Image size as WIDTHxHEIGHT")
+    parser.add_argument("--workers", type=int, nargs="+", default=default_workers())
+    args = parser.parse_args()
+    size = tuple(int(v) for v in args.size.split("x"))
+
+    directory = os.path.join(SCRATCH.name, "sources")
+    os.makedirs(directory)
+    try:
+        paths = []
+        for i in range(args.batch):
+            path = os.path.join(directory, f"upload_{i}.jpg")
+            make_jpeg(path, size)
+            paths.append(path)
+
+        print(f"{args.batch} images of {size[0]}x{size[1]} per batch, {os.cpu_count()} CPUs")
+        print(f"{'workers':>8} {'batch (s)':>10} {'images/s':>9} {'speedup':>8} {'efficiency':>11}")
+        baseline = None
+        for workers in args.workers:
+            elapsed = asyncio.run(run_batch(paths, workers))
+            throughput = args.batch / elapsed
+            baseline = baseline or throughput / workers
+            speedup = throughput / baseline
+            print(f"{workers:>8} {elapsed:>10.2f} {throughput:>9.2f} {speedup:>7.2f}x {speedup / workers:>10.0%}")
+    finally:
+        metadata_store.close()
+        os.chdir(ROOT)
+        SCRATCH.cleanup()
+
+
+if __name__ == "__main__":
+    main()
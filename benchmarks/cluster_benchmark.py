@@ -0,0 +1,177 @@
+"""
+Benchmark serving and upload throughput against the number of web workers.
+
+For each WEB_WORKERS count, starts the service in a subprocess and measures,
+with --clients concurrent clients:
+  - listing: GET /api/images requests per second (JSON built in Python)
+  - image:   GET /images/{id} requests per second (hot image cache)
+  - upload:  synchronous POST /upload images per second (watermark pool split
+             across the workers, so the total stays at the CPU count)
+and checks that one /events subscriber, connected to whichever worker accepted
+it, was told about every upload, whichever worker took it. Uploaded images are
+deleted again afterwards. Run from the repository root (Linux or macOS), with
+WEB_WORKERS left out of .env since .env overrides the environment.
+
+Usage:
+    python benchmarks/cluster_benchmark.py [--workers 1 2 4] [--clients 32] [--requests 2000] [--uploads 32]
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from uuid import uuid4
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from api.layout import layout_path
+
+BOUNDARY = "cluster-benchmark-boundary"
+
+
+def wait_for_server(port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def make_upload(size) -> bytes:
+    """Multipart body carrying one synthetic JPEG photo"""
+    buffer = io.BytesIO()
+    Image.radial_gradient('L').resize(size).convert('RGB').save(buffer, format='JPEG', quality=90)
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"photo.jpg\"\r\n"
+            f"Content-Type: image/jpeg\r\n\r\n").encode() + buffer.getvalue() + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+def request(port: int, method: str, path: str, body: bytes = None, headers: dict = None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+def run_clients(clients: int, total: int, call) -> float:
+    """Run call() total times from concurrent clients; returns the calls per second"""
+    remaining = [total]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            call()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return total / (time.perf_counter() - start)
+
+
+class EventListener(threading.Thread):
+    """Collects the image IDs announced on one /events connection"""
+
+    def __init__(self, port: int):
+        super().__init__(daemon=True)
+        self.conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        self.image_ids = set()
+
+    def run(self):
+        try:
+            self.conn.request("GET", "/events")
+            response = self.conn.getresponse()
+            for line in response:
+                if line.startswith(b"data: "):
+                    data = json.loads(line[6:])
+                    self.image_ids.update(data.get("image_ids", [data["image_id"]]))
+        except (OSError, ValueError, http.client.HTTPException):
+            pass  # Closed by stop()
+
+    def stop(self):
+        self.conn.close()
+
+
+def measure(port: int, workers: int, args, image_id: str, upload_body: bytes) -> dict:
+    env = dict(os.environ, WEB_WORKERS=str(workers), ASYNC_UPLOADS="False", RETENTION_MAX_IMAGES="0")
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers),
+               "--log-level", "warning"]
+    server = subprocess.Popen(command, cwd=ROOT, env=env)
+    uploaded = []
+    try:
+        wait_for_server(port)
+        time.sleep(1)  # Let every worker finish starting
+        listener = EventListener(port)
+        listener.start()
+
+        def upload():
+            status, body = request(port, "POST", "/upload", upload_body,
+                                   {"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"})
+            if status == 200:
+                uploaded.append(json.loads(body)["path"])
+
+        result = {
+            "listing": run_clients(args.clients, args.requests, lambda: request(port, "GET", "/api/images")),
+            "image": run_clients(args.clients, args.requests, lambda: request(port, "GET", f"/images/{image_id}")),
+            "upload": run_clients(args.clients, args.uploads, upload)
+        }
+        result["upload"] *= len(uploaded) / args.uploads  # Uploads refused with 503 do not count
+        time.sleep(1)  # Announcements from other workers arrive within CLUSTER_POLL_INTERVAL
+        listener.stop()
+        result["announced"] = len(listener.image_ids & set(uploaded))
+        result["uploaded"] = len(uploaded)
+        return result
+    finally:
+        for uploaded_id in uploaded:
+            request(port, "DELETE", f"/images/{uploaded_id}")
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="GET requests per endpoint")
+    parser.add_argument("--uploads", type=int, default=32, help="Uploads per run")
+    parser.add_argument("--size", default="3024x4032", help="Upload size as WIDTHxHEIGHT")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    upload_body = make_upload(tuple(int(v) for v in args.size.split("x")))
+    image_id = f"img_bench_{uuid4()}"
+    image_path = layout_path(os.path.join(ROOT, "images"), f"{image_id}.jpg")
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    Image.radial_gradient('L').convert('RGB').save(image_path, format='JPEG')
+    try:
+        print(f"{os.cpu_count()} CPUs, {args.clients} clients")
+        print(f"{'workers':>8} {'listing/s':>10} {'image/s':>9} {'uploads/s':>10} {'announced':>10}")
+        for workers in args.workers:
+            result = measure(args.port, workers, args, image_id, upload_body)
+            print(f"{workers:>8} {result['listing']:>10.0f} {result['image']:>9.0f} {result['upload']:>10.2f} "
+                  f"{result['announced']:>5}/{result['uploaded']:<4}")
+    finally:
+        os.remove(image_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Benchmark download throughput and server CPU per download under concurrent clients.
+
+Starts the service in a subprocess, adds a synthetic image of --size-mb and
+downloads it from N concurrent clients through:
+  - /download/{id}  FileResponse from disk (Range support, sendfile via the
+                    http.response.pathsend extension when the server supports it)
+  - /images/{id}    in-memory image cache (Range support)
+
+Each path is measured for full downloads, for interrupted downloads that restart
+from scratch (the behaviour before Range support) and for interrupted downloads
+resumed with a Range request. Server CPU is read from /proc (Linux only).
+
+Usage:
+    python benchmarks/download_benchmark.py [--clients 16] [--rounds 4] [--size-mb 6]
+    python benchmarks/download_benchmark.py --server "granian --interface asgi main:app --port {port}"
+"""
+import argparse
+import http.client
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from uuid import uuid4
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+from api.layout import layout_path
+DEFAULT_SERVER = f"{sys.executable} -m uvicorn main:app --port {{port}} --log-level warning"
+
+
+def server_cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process, from /proc/<pid>/stat"""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def wait_for_server(port: int, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def fetch(port: int, path: str, headers: dict = None, max_bytes: int = None) -> int:
+    """GET path and return the body bytes received, stopping early after max_bytes"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        conn.request("GET", path, headers=headers or {})
+        response = conn.getresponse()
+        received = 0
+        while max_bytes is None or received < max_bytes:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            received += len(chunk)
+        return received
+    finally:
+        conn.close()
+
+
+def download(port: int, path: str, mode: str, size: int) -> int:
+    if mode == "full":
+        return fetch(port, path)
+    half = size // 2
+    received = fetch(port, path, max_bytes=half)  # Connection drops halfway
+    if mode == "restart":
+        return received + fetch(port, path)
+    return received + fetch(port, path, headers={"Range": f"bytes={received}-"})
+
+
+def run_scenario(port: int, pid: int, path: str, mode: str, size: int, clients: int, rounds: int) -> dict:
+    totals = []
+    lock = threading.Lock()
+
+    def client():
+        for _ in range(rounds):
+            received = download(port, path, mode, size)
+            with lock:
+                totals.append(received)
+
+    cpu_before = server_cpu_seconds(pid)
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    cpu = server_cpu_seconds(pid) - cpu_before
+    downloads = len(totals)
+    return {
+        "downloads_per_s": downloads / elapsed,
+        "mb_per_s": sum(totals) / elapsed / 1e6,
+        "wire_mb_per_download": sum(totals) / downloads / 1e6,
+        "cpu_ms_per_download": cpu / downloads * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--rounds", type=int, default=4, help="Downloads per client per scenario")
+    parser.add_argument("--size-mb", type=float, default=6, help="Size of the synthetic image")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--server", default=DEFAULT_SERVER, help="Server command; {port} is substituted")
+    args = parser.parse_args()
+
+    image_id = f"img_bench_{uuid4()}"
+    image_path = layout_path(os.path.join(ROOT, "images"), f"{image_id}.jpg")
+    size = int(args.size_mb * 1024 * 1024)
+    os.makedirs(os.path.dirname(image_path), exist_ok=True)
+    with open(image_path, "wb") as f:
+        f.write(os.urandom(size))
+
+    env = dict(os.environ, GALLERY_WATCHER="off")
+    server = subprocess.Popen(shlex.split(args.server.format(port=args.port)), cwd=ROOT, env=env)
+    try:
+        wait_for_server(args.port)
+        print(f"{'path':<28} {'mode':<8} {'dl/s':>8} {'MB/s':>9} {'wire MB/dl':>11} {'CPU ms/dl':>10}")
+        for label, path in [("/download (file)", f"/download/{image_id}?rename_file=false"),
+                            ("/images (memory)", f"/images/{image_id}")]:
+            fetch(args.port, path)  # Warm caches
+            for mode in ("full", "restart", "resume"):
+                result = run_scenario(args.port, server.pid, path, mode, size, args.clients, args.rounds)
+                print(f"{label:<28} {mode:<8} {result['downloads_per_s']:>8.1f} {result['mb_per_s']:>9.1f} "
+                      f"{result['wire_mb_per_download']:>11.2f} {result['cpu_ms_per_download']:>10.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+        os.remove(image_path)
+
+
+if __name__ == "__main__":
+    main()
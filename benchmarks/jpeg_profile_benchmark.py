@@ -0,0 +1,133 @@
+"""
+Compare the JPEG encoder profiles on encode time, file size and fidelity.
+
+Encodes one photo at camera resolution with every JPEG_PROFILES entry and
+reports, with ratios to the "high" profile (how uploads were always encoded,
+or the first profile listed when it is left out):
+  - encode: best wall time of Image.save over --runs (ms)
+  - size:   bytes written, including any EXIF/ICC the profile keeps
+  - PSNR:   peak signal-to-noise ratio against the decoded source (dB)
+  - SSIM:   mean structural similarity of the luma, 7x7 windows (needs numpy)
+
+A synthetic photo is used unless --image is given; pass a real frame from the
+camera to choose a profile, since noise and detail drive both size and
+encode time (and "source" can only reuse the tables of a real JPEG).
+
+Usage:
+    python benchmarks/jpeg_profile_benchmark.py [--image frame.jpg] [--size 4000x3000] [--runs 3]
+"""
+import argparse
+import io
+import math
+import os
+import sys
+import time
+
+from PIL import Image, ImageChops
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.constants import JPEG_PROFILES
+from api.encoding import jpeg_save_options, source_metadata
+from functions.watermark_template import WatermarkTemplate, to_rgb
+
+SSIM_WINDOW = 7
+SSIM_STRIP_ROWS = 512  # Rows of the image compared at once, to bound memory
+
+
+def make_photo(size):
+    """Create a synthetic photo: smooth gradients, fractal detail and sensor-like noise"""
+    gradient = Image.radial_gradient('L').resize(size)
+    detail = Image.effect_mandelbrot(size, (-2.2, -1.4, 1.0, 1.4), 100)
+    noise = Image.effect_noise(size, 24)
+    return Image.merge('RGB', (gradient, detail, ImageChops.add(gradient, noise, scale=2.0)))
+
+
+def encode(image, options, runs):
+    """Return the best encode time and the encoded bytes"""
+    best = float('inf')
+    for _ in range(runs):
+        buffer = io.BytesIO()
+        start = time.perf_counter()
+        image.save(buffer, **options)
+        best = min(best, time.perf_counter() - start)
+    return best, buffer.getvalue()
+
+
+def psnr(reference, candidate):
+    histogram = ImageChops.difference(reference, candidate).histogram()
+    squared_error = sum(count * (value % 256) ** 2 for value, count in enumerate(histogram))
+    mse = squared_error / (reference.width * reference.height * len(reference.getbands()))
+    return float('inf') if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def _window_means(values):
+    """Mean of every SSIM_WINDOW x SSIM_WINDOW window, from an integral image"""
+    integral = numpy.pad(values.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    w = SSIM_WINDOW
+    return (integral[w:, w:] - integral[:-w, w:] - integral[w:, :-w] + integral[:-w, :-w]) / (w * w)
+
+
+def ssim(reference, candidate):
+    """Mean SSIM of the luma, computed in strips of rows; None without numpy"""
+    if numpy is None:
+        return None
+    x_all = numpy.asarray(reference.convert('L'), dtype=numpy.float64)
+    y_all = numpy.asarray(candidate.convert('L'), dtype=numpy.float64)
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    total, count = 0.0, 0
+    for top in range(0, x_all.shape[0] - SSIM_WINDOW + 1, SSIM_STRIP_ROWS):
+        x = x_all[top:top + SSIM_STRIP_ROWS + SSIM_WINDOW - 1]
+        y = y_all[top:top + SSIM_STRIP_ROWS + SSIM_WINDOW - 1]
+        mx, my = _window_means(x), _window_means(y)
+        vx = _window_means(x * x) - mx * mx
+        vy = _window_means(y * y) - my * my
+        cxy = _window_means(x * y) - mx * my
+        s = ((2 * mx * my + c1) * (2 * cxy + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+        total += s.sum()
+        count += s.size
+    return total / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="Camera frame to encode (default: a synthetic photo)")
+    parser.add_argument("--size", default="4000x3000", help="Synthetic photo size as WIDTHxHEIGHT")
+    parser.add_argument("--runs", type=int, default=3, help="Encodes per profile (best is reported)")
+    parser.add_argument("--profiles", nargs="+", default=list(JPEG_PROFILES), choices=list(JPEG_PROFILES))
+    args = parser.parse_args()
+
+    if args.image:
+        source = WatermarkTemplate().open(args.image)  # Applies the EXIF orientation like the pipeline
+        source.load()
+        label = os.path.basename(args.image)
+    else:
+        source = make_photo(tuple(int(v) for v in args.size.split("x")))
+        label = "synthetic photo"
+    reference = to_rgb(source)
+    if numpy is None:
+        print("numpy is not installed, SSIM is skipped (pip install numpy)")
+    print(f"{label}, {reference.width}x{reference.height}, best of {args.runs} encodes")
+
+    print(f"{'profile':<9} {'encode ms':>10} {'ratio':>8} {'size KiB':>9} {'ratio':>8} {'PSNR dB':>8} {'SSIM':>7}")
+    baseline = None
+    for name in sorted(args.profiles, key=lambda name: name != "high"):
+        profile = JPEG_PROFILES[name]
+        options = jpeg_save_options(profile, reference, source_metadata(source, profile))
+        seconds, data = encode(reference, options, args.runs)
+        with Image.open(io.BytesIO(data)) as decoded:
+            decoded = decoded.convert('RGB')
+        quality_psnr = psnr(reference, decoded)
+        quality_ssim = ssim(reference, decoded)
+        baseline = baseline or (seconds, len(data))
+        print(f"{name:<9} {seconds * 1000:>10.1f} {seconds / baseline[0]:>7.2f}x {len(data) / 1024:>9.0f} "
+              f"{len(data) / baseline[1]:>7.2f}x {quality_psnr:>8.2f} "
+              f"{'n/a' if quality_ssim is None else format(quality_ssim, '.4f'):>7}")
+
+
+if __name__ == "__main__":
+    main()
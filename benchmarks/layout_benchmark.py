@@ -0,0 +1,97 @@
+"""
+Benchmark list and lookup costs of the flat and hashed storage layouts.
+
+For each file count, fills a scratch directory with empty img_<uuid>.jpg files
+under each layout and measures:
+  - list:   a full scan with mtimes, as the gallery index load and the
+            watcher's resync do (ms per scan)
+  - lookup: os.stat of a random existing image through layout_path, as
+            get_image_path + FileResponse do (us per lookup)
+  - miss:   os.path.exists of an unknown ID (us per lookup)
+  - create: creating one more file and renaming it into place (us per file)
+
+Run with the page cache warm; pass --drop-caches (root only) to measure cold scans.
+
+Usage:
+    python benchmarks/layout_benchmark.py [--counts 1000 10000 100000] [--lookups 20000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from uuid import uuid4
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.layout import FLAT_LAYOUT, HASHED_LAYOUT, layout_path, scan_files, ensure_layout
+
+EXT = ".jpg"
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def fill(directory: str, names: list, layout: str):
+    ensure_layout(directory, layout)
+    for name in names:
+        open(layout_path(directory, name, layout), "wb").close()
+
+
+def measure(directory: str, names: list, layout: str, lookups: int, cold: bool) -> dict:
+    if cold:
+        drop_caches()
+    start = time.perf_counter()
+    listed = sum(1 for _ in scan_files(directory, EXT, layout))
+    list_ms = (time.perf_counter() - start) * 1000
+    assert listed == len(names)
+
+    sample = random.choices(names, k=lookups)
+    start = time.perf_counter()
+    for name in sample:
+        os.stat(layout_path(directory, name, layout))
+    lookup_us = (time.perf_counter() - start) / lookups * 1e6
+
+    start = time.perf_counter()
+    for _ in range(lookups):
+        os.path.exists(layout_path(directory, f"img_{uuid4()}{EXT}", layout))
+    miss_us = (time.perf_counter() - start) / lookups * 1e6
+
+    creates = min(lookups, 2000)
+    start = time.perf_counter()
+    for _ in range(creates):
+        path = layout_path(directory, f"img_{uuid4()}{EXT}", layout)
+        temp_path = path + ".tmp"
+        open(temp_path, "wb").close()
+        os.replace(temp_path, path)
+    create_us = (time.perf_counter() - start) / creates * 1e6
+    return {"list_ms": list_ms, "lookup_us": lookup_us, "miss_us": miss_us, "create_us": create_us}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--drop-caches", action="store_true", help="Drop the page cache before each scan (root only)")
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'layout':<7} {'list ms':>9} {'lookup us':>10} {'miss us':>8} {'create us':>10}")
+    for count in args.counts:
+        names = [f"img_{uuid4()}{EXT}" for _ in range(count)]
+        for layout in (FLAT_LAYOUT, HASHED_LAYOUT):
+            directory = tempfile.mkdtemp(prefix="layout_bench_", dir=".")
+            try:
+                fill(directory, names, layout)
+                result = measure(directory, names, layout, args.lookups, args.drop_caches)
+            finally:
+                shutil.rmtree(directory)
+            print(f"{count:>8} {layout:<7} {result['list_ms']:>9.1f} {result['lookup_us']:>10.2f} "
+                  f"{result['miss_us']:>8.2f} {result['create_us']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark per-upload watermarking time across image sizes.
+
+Compares the band-level compositing helpers against the previous per-pixel
+getpixel/putpixel loops by swapping the helpers used by add_watermark_with_logo,
+with the overlay asset cache and the compiled watermark templates cleared
+before every run. The "cached" column is the steady-state time once the
+template has built the font, overlay and blur mask for the resolution, and
+"regions" is the same with region compositing (the pipeline's default), which
+keeps the photo in RGB and only composites the overlay's bounding boxes. The
+last column checks that both modes produce the same RGB pixels.
+
+Usage:
+    python benchmarks/watermark_benchmark.py [--runs 3]
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+from PIL import Image, ImageChops
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import functions.add_watermark_with_logo as watermark_module
+import functions.watermark_template as template_module
+from functions.watermark_template import WatermarkTemplate, COMPOSITE_FULL, COMPOSITE_REGIONS
+import utils.asset_cache as asset_cache_module
+from utils.image_utils import apply_opacity, apply_alpha_mask
+
+IMAGE_SIZES = [(1280, 720), (1920, 1080), (3024, 4032), (4000, 3000)]
+UPLOAD_KWARGS = dict(
+    logo_path="static/logo.png",
+    font_size=1200,
+    bottom_right_image_path="static/Oxy-logo-t.png",
+    bottom_right_image_size=(300, 200),
+    bottom_right_margin=30,
+    bottom_right_opacity=200,
+    logo_opacity=200,
+    preserve_bottom_right_aspect=True,
+)
+
+
+def legacy_apply_opacity(image, opacity):
+    """Per-pixel opacity loop used before the band-level helpers"""
+    if opacity >= 255:
+        return image
+    result = Image.new('RGBA', image.size, (0, 0, 0, 0))
+    for x in range(image.width):
+        for y in range(image.height):
+            r, g, b, a = image.getpixel((x, y))
+            result.putpixel((x, y), (r, g, b, int(a * (opacity / 255))))
+    return result
+
+
+def legacy_apply_alpha_mask(image, mask):
+    """Per-pixel mask loop used before the band-level helpers"""
+    rgba = image.convert('RGBA')
+    result = Image.new('RGBA', rgba.size, (0, 0, 0, 0))
+    for x in range(rgba.width):
+        for y in range(rgba.height):
+            r, g, b, a = rgba.getpixel((x, y))
+            result.putpixel((x, y), (r, g, b, int(mask.getpixel((x, y)))))
+    return result
+
+
+def make_jpeg(size):
+    """Create a synthetic JPEG photo of the given size"""
+    image = Image.radial_gradient('L').resize(size).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+
+def time_upload(content, runs, cold=True):
+    """Return the best wall time of add_watermark_with_logo over runs"""
+    best = float('inf')
+    for _ in range(runs):
+        if cold:
+            asset_cache_module.overlay_cache.clear()
+            template_module.clear_watermark_templates()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            watermark_module.add_watermark_with_logo(image_content=content, **UPLOAD_KWARGS)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def time_template(content, runs, composite):
+    """Return the best wall time of a warm WatermarkTemplate over runs, and its RGB output"""
+    template = WatermarkTemplate(composite=composite, **UPLOAD_KWARGS)
+    best = float('inf')
+    with contextlib.redirect_stdout(io.StringIO()):
+        template.apply(content)  # Build the layout for this resolution
+        for _ in range(runs):
+            start = time.perf_counter()
+            result = template.apply(content)
+            best = min(best, time.perf_counter() - start)
+    return best, result.convert('RGB')
+
+
+def use_helpers(opacity_fn, mask_fn):
+    asset_cache_module.apply_opacity = opacity_fn
+    template_module.apply_alpha_mask = mask_fn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3, help="Runs per size (best is reported)")
+    args = parser.parse_args()
+
+    print(f"{'size':>12} {'before (s)':>12} {'after (s)':>12} {'cached (s)':>12} {'regions (s)':>12} {'speedup':>9} {'same':>5}")
+    for size in IMAGE_SIZES:
+        content = make_jpeg(size)
+        use_helpers(legacy_apply_opacity, legacy_apply_alpha_mask)
+        before = time_upload(content, args.runs)
+        use_helpers(apply_opacity, apply_alpha_mask)
+        after = time_upload(content, args.runs)
+        cached = time_upload(content, args.runs, cold=False)
+        _, full_result = time_template(content, 1, COMPOSITE_FULL)
+        regions, regions_result = time_template(content, args.runs, COMPOSITE_REGIONS)
+        same = ImageChops.difference(full_result, regions_result).getbbox() is None
+        print(f"{size[0]:>5}x{size[1]:<6} {before:>12.3f} {after:>12.3f} {cached:>12.3f} {regions:>12.3f} "
+              f"{before / regions:>8.1f}x {'yes' if same else 'NO':>5}")
+
+
+if __name__ == "__main__":
+    main()
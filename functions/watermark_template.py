@@ -0,0 +1,424 @@
+from PIL import Image, ImageDraw, ImageFilter, ImageOps, ExifTags
+from io import BytesIO
+import os
+import sys
+import threading
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.image_utils import load_font, draw_rounded_rectangle, draw_rounded_rectangle_border, apply_alpha_mask
+from utils.asset_cache import overlay_cache
+
+MAX_TEMPLATE_LAYOUTS = 4  # Input resolutions whose overlays are kept per template
+TEXT_MARGIN = 20  # Distance of the text box from the image edges
+
+# Compositing modes
+COMPOSITE_FULL = "full"  # Composite a full-size RGBA overlay over the whole photo and return RGBA
+COMPOSITE_REGIONS = "regions"  # Composite only the overlay's bounding boxes, in place on the RGB photo
+
+
+def merge_boxes(boxes, size):
+    """Clip (x1, y1, x2, y2) boxes to an image of size and merge overlapping ones until none overlap"""
+    width, height = size
+    merged = []
+    for x1, y1, x2, y2 in boxes:
+        box = (max(0, x1), max(0, y1), min(width, x2), min(height, y2))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            continue
+        overlapping = True
+        while overlapping:
+            overlapping = False
+            for other in merged:
+                if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+                    merged.remove(other)
+                    box = (min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3]))
+                    overlapping = True
+                    break
+        merged.append(box)
+    return merged
+
+
+def to_rgb(image):
+    """Get an RGB version of an image, flattening any transparency onto white"""
+    if image.mode == 'RGB':
+        return image
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        rgba = image.convert('RGBA')
+        rgb_image = Image.new('RGB', rgba.size, (255, 255, 255))
+        rgb_image.paste(rgba, mask=rgba.getchannel('A'))
+        return rgb_image
+    return image.convert('RGB')
+
+
+def place(position, image_size, item_size, margin, default):
+    """Get the top-left corner of an item_size box at a named position inside image_size"""
+    img_width, img_height = image_size
+    width, height = item_size
+    position_map = {
+        'top-left': (margin, margin),
+        'top-right': (img_width - width - margin, margin),
+        'bottom-left': (margin, img_height - height - margin),
+        'bottom-right': (img_width - width - margin, img_height - height - margin),
+        'center': ((img_width - width) // 2, (img_height - height) // 2)
+    }
+    return position_map.get(position, position_map[default])
+
+
+class WatermarkLayout:
+    """The overlay of a template for one input resolution.
+
+    ops draw the logo, bottom-right image and text box in order onto a layer
+    whose top-left corner is at origin in image coordinates, and boxes holds
+    the area each op can touch. overlay is the result on a transparent
+    full-size layer (full compositing); regions holds the overlay cropped to
+    disjoint boxes covering every op and the blur (region compositing).
+    blur_box and blur_mask describe the blurred background behind the logo,
+    which depends on each photo.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.ops = []
+        self.boxes = []
+        self.blur_box = None
+        self.blur_mask = None
+        self.overlay = None
+        self.regions = []
+
+    def add(self, op, box):
+        self.ops.append(op)
+        self.boxes.append(box)
+
+    def draw(self, layer, origin=(0, 0)):
+        for op in self.ops:
+            op(layer, origin)
+
+
+def _contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+
+def _paste_op(image, position):
+    """Get an op pasting an RGBA image at position, and the box it covers"""
+    x, y = position
+    op = lambda layer, origin: layer.paste(image, (x - origin[0], y - origin[1]), image)
+    return op, (x, y, x + image.width, y + image.height)
+
+
+class WatermarkTemplate:
+    """add_watermark_with_logo's settings compiled once and reused across uploads.
+
+    The font is resolved once, and for each input resolution the placement,
+    the overlay layer and the rounded blur mask are built on first use and
+    cached, so an upload at an already seen resolution only blurs the
+    background behind the logo and runs one composite. Layouts are rebuilt
+    when the logo or bottom-right image changes on disk. Produces the same
+    pixels as building the overlay from scratch.
+
+    With composite="regions" the photo stays RGB and only the bounding boxes
+    of the overlay items are composited, in place, instead of converting the
+    whole frame to RGBA and compositing a full-size overlay over it. The
+    result is the same RGB image the full composite flattens to, for a
+    fraction of the memory and time; photos with transparency are flattened
+    onto white first.
+    """
+
+    def __init__(self,
+                 watermark_text="Snapped by Oxy at WSO2Con Asia",
+                 font_size=180,
+                 font_color=(255, 255, 255),
+                 add_box=True,
+                 box_color=(0, 0, 0),
+                 box_opacity=120,
+                 box_padding=20,
+                 box_border=True,
+                 border_color=(200, 200, 200),
+                 border_width=1,
+                 box_rounded=True,
+                 corner_radius=8,
+                 position='bottom-right',
+                 logo_path=None,
+                 logo_position='top-left',
+                 logo_size=(400, 400),
+                 logo_opacity=255,
+                 logo_margin=20,
+                 preserve_logo_aspect=True,
+                 logo_blur_background=True,
+                 blur_radius=15,
+                 blur_area_padding=30,
+                 blur_opacity=180,
+                 bottom_right_image_path=None,
+                 bottom_right_image_size=(300, 200),
+                 bottom_right_margin=20,
+                 bottom_right_opacity=255,
+                 preserve_bottom_right_aspect=True,
+                 add_watermark=False,
+                 composite=COMPOSITE_FULL,
+                 max_layouts=MAX_TEMPLATE_LAYOUTS):
+        self.watermark_text = watermark_text
+        self.font_size = font_size
+        self.font_color = font_color
+        self.add_box = add_box
+        self.box_color = box_color
+        self.box_opacity = box_opacity
+        self.box_padding = box_padding
+        self.box_border = box_border
+        self.border_color = border_color
+        self.border_width = border_width
+        self.box_rounded = box_rounded
+        self.corner_radius = corner_radius
+        self.position = position
+        self.logo_path = logo_path
+        self.logo_position = logo_position
+        self.logo_size = logo_size
+        self.logo_opacity = logo_opacity
+        self.logo_margin = logo_margin
+        self.preserve_logo_aspect = preserve_logo_aspect
+        self.logo_blur_background = logo_blur_background
+        self.blur_radius = blur_radius
+        self.blur_area_padding = blur_area_padding
+        self.blur_opacity = blur_opacity
+        self.bottom_right_image_path = bottom_right_image_path
+        self.bottom_right_image_size = bottom_right_image_size
+        self.bottom_right_margin = bottom_right_margin
+        self.bottom_right_opacity = bottom_right_opacity
+        self.preserve_bottom_right_aspect = preserve_bottom_right_aspect
+        self.add_watermark = add_watermark
+        if composite not in (COMPOSITE_FULL, COMPOSITE_REGIONS):
+            raise ValueError(f"Unknown composite mode: {composite}")
+        self.composite = composite
+        self.max_layouts = max_layouts
+        self._font = None
+        self._layouts = {}  # (size, asset mtimes) -> WatermarkLayout, oldest first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def font(self):
+        """The watermark font, looked up once instead of on every upload"""
+        if self._font is None:
+            self._font = load_font(self.font_size)
+        return self._font
+
+    def _asset_versions(self) -> tuple:
+        return tuple(
+            os.stat(path).st_mtime_ns if path and os.path.exists(path) else None
+            for path in (self.logo_path, self.bottom_right_image_path)
+        )
+
+    def layout(self, size) -> WatermarkLayout:
+        """Get the layout for an input resolution, building it on first use"""
+        key = (tuple(size), self._asset_versions())
+        with self._lock:
+            layout = self._layouts.get(key)
+            if layout is not None:
+                self.hits += 1
+                return layout
+
+        layout = self._build_layout(key[0])
+
+        with self._lock:
+            self.misses += 1
+            for stale_key in [k for k in self._layouts if k[1] != key[1]]:
+                del self._layouts[stale_key]
+            self._layouts[key] = layout
+            while len(self._layouts) > self.max_layouts:
+                del self._layouts[next(iter(self._layouts))]
+        return layout
+
+    def _build_layout(self, size) -> WatermarkLayout:
+        layout = WatermarkLayout(size)
+        img_width, img_height = size
+
+        if self.logo_path is None:
+            print("No logo path provided, skipping logo addition.")
+        elif not os.path.exists(self.logo_path):
+            print(f"Warning: Logo file '{self.logo_path}' does not exist. Skipping logo addition. OS path {os.getcwd()}")
+        else:
+            try:
+                logo = overlay_cache.get(self.logo_path, self.logo_size, self.preserve_logo_aspect, self.logo_opacity)
+                print(f"Logo prepared at: {logo.width}x{logo.height}")
+                logo_x, logo_y = place(self.logo_position, size, logo.size, self.logo_margin, 'top-left')
+
+                if self.logo_blur_background:
+                    blur_x1 = max(0, logo_x - self.blur_area_padding)
+                    blur_y1 = max(0, logo_y - self.blur_area_padding)
+                    blur_x2 = min(img_width, logo_x + logo.width + self.blur_area_padding)
+                    blur_y2 = min(img_height, logo_y + logo.height + self.blur_area_padding)
+                    if blur_x2 > blur_x1 and blur_y2 > blur_y1:
+                        layout.blur_box = (blur_x1, blur_y1, blur_x2, blur_y2)
+                        # Rounded rectangle mask for smooth blur edges
+                        layout.blur_mask = Image.new('L', (blur_x2 - blur_x1, blur_y2 - blur_y1), 0)
+                        mask_corner_radius = min(20, (blur_x2 - blur_x1) // 4, (blur_y2 - blur_y1) // 4)
+                        ImageDraw.Draw(layout.blur_mask).rounded_rectangle(
+                            [0, 0, blur_x2 - blur_x1, blur_y2 - blur_y1],
+                            radius=mask_corner_radius,
+                            fill=self.blur_opacity
+                        )
+
+                layout.add(*_paste_op(logo, (logo_x, logo_y)))
+            except Exception as logo_error:
+                print(f"Warning: Could not add logo - {str(logo_error)}")
+
+        if self.bottom_right_image_path and os.path.exists(self.bottom_right_image_path):
+            try:
+                bottom_right_img = overlay_cache.get(self.bottom_right_image_path, self.bottom_right_image_size,
+                                                     self.preserve_bottom_right_aspect, self.bottom_right_opacity)
+                br_x = img_width - bottom_right_img.width - self.bottom_right_margin
+                br_y = img_height - bottom_right_img.height - self.bottom_right_margin
+                layout.add(*_paste_op(bottom_right_img, (br_x, br_y)))
+                print(f"Bottom-right image placed at position: ({br_x}, {br_y})")
+            except Exception as br_error:
+                print(f"Warning: Could not add bottom-right image - {str(br_error)}")
+        elif self.bottom_right_image_path:
+            print(f"Warning: Bottom-right image file '{self.bottom_right_image_path}' does not exist.")
+
+        if self.add_watermark and self.watermark_text:
+            layout.add(*self._text_op(size))
+
+        overlay = Image.new('RGBA', size, (0, 0, 0, 0))
+        layout.draw(overlay)
+        if self.composite == COMPOSITE_FULL:
+            layout.overlay = overlay
+        else:
+            boxes = layout.boxes + ([layout.blur_box] if layout.blur_box else [])
+            layout.regions = [(box, overlay.crop(box)) for box in merge_boxes(boxes, size)]
+        return layout
+
+    def _text_op(self, size):
+        """Measure and place the text box once; the returned op only draws it. Also returns the box it covers"""
+        bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), self.watermark_text, font=self.font)
+        text_width = bbox[2] - bbox[0]
+        text_height = bbox[3] - bbox[1]
+        box_padding = self.box_padding if self.add_box else 0
+        box_width = text_width + (box_padding * 2)
+        box_height = text_height + (box_padding * 2)
+        box_x, box_y = place(self.position, size, (box_width, box_height), TEXT_MARGIN, 'bottom-right')
+
+        def op(layer, origin):
+            x, y = box_x - origin[0], box_y - origin[1]
+            self._draw_text_box(ImageDraw.Draw(layer), x, y, box_width, box_height, box_padding)
+
+        # The border grows outwards and the text ink may reach past its measured box
+        border = self.border_width if self.add_box and self.box_border else 0
+        text_x, text_y = box_x + box_padding, box_y + box_padding
+        box = (min(box_x - border, text_x + bbox[0]), min(box_y - border, text_y + bbox[1]),
+               max(box_x + box_width + border + 1, text_x + bbox[2] + 1),
+               max(box_y + box_height + border + 1, text_y + bbox[3] + 1))
+        return op, box
+
+    def _draw_text_box(self, draw, box_x, box_y, box_width, box_height, box_padding):
+        if self.add_box:
+            box_color_with_opacity = (*self.box_color, self.box_opacity)
+            if self.box_rounded:
+                draw_rounded_rectangle(draw, box_x, box_y, box_x + box_width,
+                                       box_y + box_height, self.corner_radius, box_color_with_opacity)
+            else:
+                draw.rectangle([box_x, box_y, box_x + box_width, box_y + box_height],
+                               fill=box_color_with_opacity)
+
+            if self.box_border:
+                border_color_with_opacity = (*self.border_color, 255)
+                if self.box_rounded:
+                    draw_rounded_rectangle_border(draw, box_x, box_y, box_x + box_width,
+                                                  box_y + box_height, self.corner_radius,
+                                                  border_color_with_opacity, self.border_width)
+                else:
+                    for i in range(self.border_width):
+                        draw.rectangle([box_x - i, box_y - i, box_x + box_width + i,
+                                        box_y + box_height + i],
+                                       outline=border_color_with_opacity, width=1)
+
+        draw.text((box_x + box_padding, box_y + box_padding), self.watermark_text,
+                  font=self.font, fill=(*self.font_color, 255))
+
+    def _blur_region(self, working_image, layout):
+        """Build the overlay inside the blur box: the blurred photo with the overlay items drawn over it"""
+        blur_x1, blur_y1, blur_x2, blur_y2 = layout.blur_box
+        blurred_area = working_image.crop(layout.blur_box).filter(ImageFilter.GaussianBlur(radius=self.blur_radius))
+        blurred_with_opacity = apply_alpha_mask(blurred_area, layout.blur_mask)
+        region = Image.new('RGBA', (blur_x2 - blur_x1, blur_y2 - blur_y1), (0, 0, 0, 0))
+        region.paste(blurred_with_opacity, (0, 0), blurred_with_opacity)
+        layout.draw(region, (blur_x1, blur_y1))
+        return region
+
+    def open(self, image_content, max_dimension=None):
+        """Open an image from byte content, a file path or a file object, downscaled to max_dimension.
+
+        The EXIF orientation is applied to the pixels, so the logo lands in
+        the corner of the photo as it is viewed.
+        """
+        if isinstance(image_content, (bytes, bytearray)):
+            image_content = BytesIO(image_content)
+        original_image = Image.open(image_content)
+        if max_dimension and max(original_image.size) > max_dimension:
+            # JPEG decodes straight at 1/2, 1/4 or 1/8 scale, then resize the rest of the way
+            original_image.draft('RGB', (max_dimension, max_dimension))
+            original_image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        if original_image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+            ImageOps.exif_transpose(original_image, in_place=True)
+        return original_image
+
+    def apply(self, image_content, max_dimension=None):
+        """Watermark an image (bytes, path, file object or PIL image).
+
+        Returns the RGBA result, or with region compositing the RGB result,
+        which is the image passed in when that was already RGB.
+        """
+        if isinstance(image_content, Image.Image):
+            original_image = image_content
+        else:
+            original_image = self.open(image_content, max_dimension)
+        original_size = original_image.size
+        print(f"Original image dimensions: {original_size[0]}x{original_size[1]}")
+        if self.composite == COMPOSITE_REGIONS:
+            return self._apply_regions(original_image)
+
+        working_image = original_image.convert('RGBA')
+        layout = self.layout(original_size)
+        overlay = layout.overlay
+        if layout.blur_box is not None:
+            overlay = overlay.copy()
+            overlay.paste(self._blur_region(working_image, layout), layout.blur_box[:2])
+
+        final_image = Image.alpha_composite(working_image, overlay)
+        print(f"Final image dimensions: {final_image.size[0]}x{final_image.size[1]} (preserved)")
+        return final_image
+
+    def _apply_regions(self, original_image):
+        image = to_rgb(original_image)
+        image.load()
+        layout = self.layout(image.size)
+        for box, patch in layout.regions:
+            base = image.crop(box).convert('RGBA')
+            if layout.blur_box is not None and _contains(box, layout.blur_box):
+                # Regions are disjoint, so the blur still sees the untouched photo
+                patch = patch.copy()
+                patch.paste(self._blur_region(image, layout), (layout.blur_box[0] - box[0], layout.blur_box[1] - box[1]))
+            image.paste(Image.alpha_composite(base, patch).convert('RGB'), box[:2])
+        print(f"Final image dimensions: {image.size[0]}x{image.size[1]} (preserved, {len(layout.regions)} regions composited)")
+        return image
+
+    def stats(self) -> dict:
+        """Get cached layout count and hit/miss counters"""
+        with self._lock:
+            return {"layouts": len(self._layouts), "hits": self.hits, "misses": self.misses}
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_watermark_template(**options) -> WatermarkTemplate:
+    """Get the shared template for a set of add_watermark_with_logo options, compiling it on first use"""
+    key = tuple(sorted((name, tuple(value) if isinstance(value, list) else value) for name, value in options.items()))
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is None:
+            template = _templates[key] = WatermarkTemplate(**options)
+        return template
+
+
+def clear_watermark_templates():
+    """Drop every shared template, e.g. to time uploads from a cold start"""
+    with _templates_lock:
+        _templates.clear()
@@ -1,17 +1,57 @@
 import os
 import uvicorn
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
 from api.endpoints import router
+from api.pipeline import watermark_pool
+from api.jobs import upload_jobs
+from api.gallery_index import image_index, qr_index
+from api.watcher import gallery_watcher
+from api.notifications import image_events
+from api.storage import remove_stale_temp_files
+from api.retention import retention_service
+from api.constants import INCOMING_DIR
+from api.layout import gallery_directories, prepare_layout
+from api.services import sync_metadata
+from api.metadata import metadata_store
+from api.cluster import cluster_bus, web_workers
 
-app = FastAPI(title="Unitree Gallery Service", description="A simple image gallery service")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    image_events.bind()
+    cluster_bus.start()
+    prepare_layout()
+    remove_stale_temp_files([INCOMING_DIR] + [directory for directory, _ in gallery_directories()])
+    image_index.load()
+    qr_index.load()
+    if cluster_bus.is_leader:
+        sync_metadata()  # The other web workers share the same database
+    gallery_watcher.start()
+    upload_jobs.start()
+    yield
+    cluster_bus.stop()
+    retention_service.stop()
+    gallery_watcher.stop()
+    await upload_jobs.stop()
+    watermark_pool.shutdown()
+    metadata_store.close()
+
+# Run by one web worker at a time; another takes over if it exits
+cluster_bus.on_leader(retention_service.start)
+cluster_bus.on_leader(upload_jobs.recover, periodic=True)
+
+app = FastAPI(title="Unitree Gallery Service", description="A simple image gallery service", lifespan=lifespan)
 
 # Include API routes
 app.include_router(router, prefix="")
 
 def main():
-    print("Starting Unitree Gallery Service...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    workers = web_workers()
+    print(f"Starting Unitree Gallery Service with {workers} worker(s)...")
+    # Several workers need the app as an import string so each process builds its own
+    uvicorn.run("main:app" if workers > 1 else app, host="0.0.0.0", port=8000, workers=workers)
 
 if __name__ == "__main__":
     main()
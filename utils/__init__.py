@@ -1,3 +1,4 @@
-from .image_utils import load_font, save_image_watermark, draw_rounded_rectangle, draw_rounded_rectangle_border
+from .image_utils import load_font, save_image_watermark, draw_rounded_rectangle, draw_rounded_rectangle_border, apply_opacity, apply_alpha_mask
+from .asset_cache import overlay_cache, resize_overlay
 
-__all__ = ['load_font', 'save_image_watermark', 'draw_rounded_rectangle', 'draw_rounded_rectangle_border']
\ No newline at end of file
+__all__ = ['load_font', 'save_image_watermark', 'draw_rounded_rectangle', 'draw_rounded_rectangle_border', 'apply_opacity', 'apply_alpha_mask', 'overlay_cache', 'resize_overlay']
\ No newline at end of file
@@ -0,0 +1,81 @@
+from PIL import Image
+import os
+import threading
+
+from .image_utils import apply_opacity
+
+
+def resize_overlay(image, target_size, preserve_aspect=True):
+    """Resize an overlay image to fit target_size, optionally preserving aspect ratio"""
+    if not target_size:
+        return image
+    if not preserve_aspect:
+        return image.resize(target_size, Image.Resampling.LANCZOS)
+
+    aspect = image.width / image.height
+    target_width, target_height = target_size
+    if target_width / target_height > aspect:
+        new_height = target_height
+        new_width = int(target_height * aspect)
+    else:
+        new_width = target_width
+        new_height = int(target_width / aspect)
+    return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+
+class OverlayAssetCache:
+    """In-memory cache of ready-to-paste RGBA overlays (logos, branding images).
+
+    Entries are keyed by (path, mtime, target size, aspect flag, opacity), so a
+    file changed on disk misses and replaces every stale entry for that path.
+    Cached images are shared between callers and must not be modified in place.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, target_size=None, preserve_aspect=True, opacity=255):
+        """Return the prepared RGBA overlay for path, loading it on a miss"""
+        mtime = os.stat(path).st_mtime_ns
+        key = (path, mtime, tuple(target_size) if target_size else None, preserve_aspect, opacity)
+        with self._lock:
+            overlay = self._entries.get(key)
+            if overlay is not None:
+                self.hits += 1
+                return overlay
+
+        with Image.open(path) as source:
+            overlay = source.convert('RGBA')
+        overlay = resize_overlay(overlay, target_size, preserve_aspect)
+        overlay = apply_opacity(overlay, opacity)
+
+        with self._lock:
+            self.misses += 1
+            for stale_key in [k for k in self._entries if k[0] == path and k[1] != mtime]:
+                del self._entries[stale_key]
+            self._entries[key] = overlay
+        return overlay
+
+    def clear(self):
+        """Drop all cached overlays and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        """Get cache size and hit/miss counters"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0
+            }
+
+
+overlay_cache = OverlayAssetCache()
@@ -21,6 +21,23 @@ def load_font(font_size):
     return ImageFont.load_default()
 
 
+def apply_opacity(image, opacity):
+    """Scale the alpha band of an RGBA image by opacity (0-255)"""
+    if opacity >= 255:
+        return image
+    alpha_table = [int(a * (opacity / 255)) for a in range(256)]
+    result = image.copy()
+    result.putalpha(image.getchannel('A').point(alpha_table))
+    return result
+
+
+def apply_alpha_mask(image, mask):
+    """Return an RGBA copy of image whose alpha band is replaced by an L mask"""
+    result = image.convert('RGBA')
+    result.putalpha(mask)
+    return result
+
+
 def save_image_watermark(image, output_path, original_size):
     """Save image with appropriate format conversion"""
     output_extension = os.path.splitext(output_path)[1].lower()